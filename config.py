@@ -9,19 +9,25 @@
 from __future__ import annotations
 
 import os
+import sys
 from pathlib import Path
-from dotenv import load_dotenv
+from typing import NamedTuple
 
-load_dotenv()
+from dotenv import load_dotenv
 
 # ─── Пути проекта ──────────────────────────────────────────────────────────────
 BASE_DIR = Path(__file__).resolve().parent
+
+# .env читается только из корня проекта и только если он есть: в Docker/systemd
+# переменные уже заданы окружением, и обход дерева каталогов в поисках .env не нужен.
+_ENV_FILE = BASE_DIR / ".env"
+if _ENV_FILE.is_file():
+    load_dotenv(_ENV_FILE, override=False)
+
 DATA_DIR = BASE_DIR / "data"
 LOGS_DIR = BASE_DIR / "logs"
 STATIC_DIR = BASE_DIR / "static"
-
-DATA_DIR.mkdir(exist_ok=True)
-LOGS_DIR.mkdir(exist_ok=True)
+# data/ и logs/ создаются там, где в них пишут (scraper._save_products, logger) — не при импорте
 
 RAW_PRODUCTS_PATH = DATA_DIR / "raw_products.json"
 
@@ -32,12 +38,30 @@ LOG_FILE = LOGS_DIR / "bot.log"
 # ─── ChromaDB ──────────────────────────────────────────────────────────────────
 CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", str(BASE_DIR / "chroma_db"))
 CHROMA_COLLECTION_NAME = os.getenv("CHROMA_COLLECTION_NAME", "vrk_products")
+# Сервер ChromaDB (chroma run / образ chromadb/chroma). Пусто — встроенная БД в CHROMA_PERSIST_DIR.
+# С сервером API, Telegram-бот и парсер работают с одной базой, а не открывают одни файлы из разных процессов
+CHROMA_HOST = os.getenv("CHROMA_HOST", "")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+# Документов в одном upsert/delete: большие пачки замедляют ChromaDB и раздувают память
+CHROMA_UPSERT_BATCH_SIZE = int(os.getenv("CHROMA_UPSERT_BATCH_SIZE", "200"))
 
 # ─── Telegram ──────────────────────────────────────────────────────────────────
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 
 # ─── API ───────────────────────────────────────────────────────────────────────
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
+# Сайты, с которых виджет обращается к API (через запятую); * — любые
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
+
+# ─── Сессии ────────────────────────────────────────────────────────────────────
+# Пусто — сессии хранятся только в памяти процесса (один воркер uvicorn).
+# Для нескольких воркеров задайте Redis, например redis://localhost:6379/0
+REDIS_URL = os.getenv("REDIS_URL", "")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "3600"))
+# Сколько сессий держать в памяти процесса; при переполнении вытесняются давно неактивные
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+# Сколько последних сообщений истории хранится в сессии и передаётся в LLM
+SESSION_HISTORY_LENGTH = 20
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # ГЛАВНЫЕ КАТЕГОРИИ (6 шт., соответствуют разделам сайта)
@@ -144,15 +168,18 @@ VENT_PARTS_SUBCAT_FILTER: dict[str, list[str]] = {
 # ─── Парсер ────────────────────────────────────────────────────────────────────
 BASE_SITE_URL = "https://xn----ctbjabaraetfwdan0bzal0e5b4cwe.xn--p1ai"
 
+CATALOG_URL_PREFIX = BASE_SITE_URL + "/catalog/"
+
 # Только 6 активных категорий — Электроприводы и Фильтры исключены.
-START_URLS: list[str] = [
-    f"{BASE_SITE_URL}/catalog/{slug}" for slug in CATEGORY_SLUG_MAP
-]
+START_URLS: tuple[str, ...] = tuple(CATALOG_URL_PREFIX + slug for slug in CATEGORY_SLUG_MAP)
 
 SCRAPER_REQUEST_DELAY: float = 1.5
+SCRAPER_CONCURRENCY: int = 8  # одновременных запросов к сайту (пауза SCRAPER_REQUEST_DELAY — внутри каждого)
 SCRAPER_MAX_RETRIES: int = 3
 SCRAPER_TIMEOUT: int = 30
 SCRAPER_REMOVE_MISSING: bool = True
+# Проверять товары моделью при чтении raw_products.json (для отладки; файл пишет сам парсер)
+SCRAPER_VALIDATE_ON_LOAD: bool = os.getenv("SCRAPER_VALIDATE_ON_LOAD", "").lower() in ("1", "true", "yes")
 
 # ─── Расписание парсера (APScheduler cron) ─────────────────────────────────────
 SCRAPER_CRON_DAY_OF_WEEK = os.getenv("SCRAPER_CRON_DAY_OF_WEEK", "mon")
@@ -762,13 +789,47 @@ FUNNEL_SCENARIOS: dict[str, dict] = {
     },
 }
 
+
+def _intern_steps(steps: list[dict]) -> None:
+    """
+    Интернирует step_id, подписи и значения вариантов.
+
+    Ответ кнопкой приходит тем же текстом (label/value), и после sys.intern()
+    в process_message сравнение с вариантами шага сводится к сравнению ссылок.
+    """
+    for step in steps:
+        step["step_id"] = sys.intern(step["step_id"])
+        for opt in step.get("options", []):
+            for key in ("label", "value", "filter_value"):
+                if key in opt:
+                    opt[key] = sys.intern(opt[key])
+
+
+for _steps in (
+    [PRODUCT_TYPE_STEP], FACADE_STEPS, ACOUSTIC_STEPS, INDOOR_STEPS, SLOT_STEPS,
+    *(sc["steps"] for sc in FUNNEL_SCENARIOS.values()),
+):
+    _intern_steps(_steps)
+del _steps
+
+
 # ─── Контакты менеджера ────────────────────────────────────────────────────────
-MANAGER_CONTACTS = {
-    "phone": "+7 (800) 505-63-73",
-    "email": "zakaz@ventreshetki.com",
-    "address": "г. Мытищи, МО, пос. Кардо-Лента, ул. Садовая, д. 19",
-    "work_hours": "Пн — Пт: 09:00–18:00",
-}
+
+class ManagerContacts(NamedTuple):
+    """Контакты менеджера (неизменяемые; для JSON — ._asdict())."""
+
+    phone: str
+    email: str
+    address: str
+    work_hours: str
+
+
+MANAGER_CONTACTS = ManagerContacts(
+    phone="+7 (800) 505-63-73",
+    email="zakaz@ventreshetki.com",
+    address="г. Мытищи, МО, пос. Кардо-Лента, ул. Садовая, д. 19",
+    work_hours="Пн — Пт: 09:00–18:00",
+)
 
 # ─── Системный промпт для LLM ─────────────────────────────────────────────────
 SYSTEM_PROMPT = """### РОЛЬ И КОНТЕКСТ
@@ -807,15 +868,28 @@ SYSTEM_PROMPT = """### РОЛЬ И КОНТЕКСТ
 4. Если запрос на аналог/нестандарт — используй соответствующие аргументы.
 5. Не задавай все вопросы сразу, один-два за раз.
 
+### СТИЛЬ: Деловой, экспертный. Маркированные списки. **Жирным** — названия и цены. Русский язык.
+
 ### ТЕКУЩИЕ АКТИВНЫЕ ФИЛЬТРЫ
 {active_filters}
 
 ### КОНТЕКСТ ИЗ БАЗЫ ЗНАНИЙ
 {context}
-
-### СТИЛЬ: Деловой, экспертный. Маркированные списки. **Жирным** — названия и цены. Русский язык.
 """
 
+# Шаблон режется на части один раз при импорте: на каждый запрос к LLM
+# остаётся только склейка строк вместо разбора шаблона в str.format().
+# Все статические инструкции стоят до фильтров и контекста — общий префикс промпта
+# одинаков для всех клиентов и попадает в кеш префиксов у провайдера LLM.
+_PROMPT_HEAD, _PROMPT_REST = SYSTEM_PROMPT.split("{active_filters}", 1)
+_PROMPT_MID, _PROMPT_TAIL = _PROMPT_REST.split("{context}", 1)
+
+
+def render_system_prompt(active_filters: str, context: str) -> str:
+    """То же, что SYSTEM_PROMPT.format(active_filters=..., context=...)."""
+    return "".join((_PROMPT_HEAD, active_filters, _PROMPT_MID, context, _PROMPT_TAIL))
+
+
 # ─── Приветственное сообщение Telegram ─────────────────────────────────────────
 TELEGRAM_WELCOME_TEXT = (
     "Добро пожаловать!\n\n"
@@ -8,11 +8,20 @@
 
 Единый интерфейс: get_llm() возвращает BaseChatModel, который
 используется остальным кодом без привязки к конкретному провайдеру.
+Клиент кешируется отдельно для каждого event loop: его HTTP-пул
+соединений привязан к тому loop, в котором создан.
 """
 
 from __future__ import annotations
 
+import asyncio
+import base64
+import functools
+import json
 import os
+import time
+import weakref
+from dataclasses import dataclass
 from typing import Optional
 
 from langchain_core.language_models.chat_models import BaseChatModel
@@ -21,31 +30,78 @@ from logger import get_logger
 
 log = get_logger(__name__)
 
-_cached_llm: Optional[BaseChatModel] = None
+_cached_llm: Optional[BaseChatModel] = None  # вне event loop (скрипты, CLI)
+# Отдельный клиент на каждый event loop; запись исчезает вместе с loop
+_loop_llms: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, BaseChatModel] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+# ─── Переменные окружения ──────────────────────────────────────────────────────
+
+@dataclass(frozen=True)
+class _LLMEnv:
+    """Снимок переменных окружения, нужных провайдерам (читается один раз)."""
+
+    gigachat_credentials: Optional[str]
+    gigachat_client_id: Optional[str]
+    gigachat_client_secret: Optional[str]
+    gigachat_scope: str
+    yandex_folder_id: Optional[str]
+    yandex_api_key: Optional[str]
+    yandex_key_id: Optional[str]
+    yandex_service_account_id: Optional[str]
+    yandex_private_key: Optional[str]
+    openrouter_api_key: Optional[str]
+    openrouter_model: str
+    openai_api_key: Optional[str]
+    openai_model: str
+
+
+@functools.cache
+def _env() -> _LLMEnv:
+    """Читает ключи провайдеров из окружения; результат кешируется до reset_llm_cache()."""
+    env = os.environ
+    return _LLMEnv(
+        gigachat_credentials=env.get("GIGACHAT_CREDENTIALS"),
+        gigachat_client_id=env.get("GIGACHAT_CLIENT_ID"),
+        gigachat_client_secret=env.get("GIGACHAT_CLIENT_SECRET"),
+        gigachat_scope=env.get("GIGACHAT_SCOPE", "GIGACHAT_API_PERS"),
+        yandex_folder_id=env.get("YANDEX_FOLDER_ID"),
+        yandex_api_key=env.get("YANDEX_API_KEY"),
+        yandex_key_id=env.get("YANDEX_KEY_ID"),
+        yandex_service_account_id=env.get("YANDEX_SERVICE_ACCOUNT_ID"),
+        yandex_private_key=env.get("YANDEX_PRIVATE_KEY"),
+        openrouter_api_key=env.get("OPENROUTER_API_KEY"),
+        openrouter_model=env.get("OPENROUTER_MODEL", "openai/gpt-4o-mini"),
+        openai_api_key=env.get("OPENAI_API_KEY"),
+        openai_model=env.get("OPENAI_MODEL", "gpt-4o-mini"),
+    )
 
 
 # ─── Провайдеры ────────────────────────────────────────────────────────────────
+#
+# Каждый провайдер описан парой: probe — дешёвая проверка ключей в окружении
+# (без импорта SDK), build — импорт SDK и создание клиента. SDK импортируется
+# только для провайдера, прошедшего probe.
 
-def _try_gigachat() -> Optional[BaseChatModel]:
-    """GigaChat (Сбер) через langchain-community."""
-    credentials = os.getenv("GIGACHAT_CREDENTIALS")
-    client_id = os.getenv("GIGACHAT_CLIENT_ID")
-    client_secret = os.getenv("GIGACHAT_CLIENT_SECRET")
+def _probe_gigachat(cfg: _LLMEnv) -> bool:
+    return bool(cfg.gigachat_credentials or (cfg.gigachat_client_id and cfg.gigachat_client_secret))
 
-    if not credentials and not (client_id and client_secret):
-        return None
 
+def _build_gigachat(cfg: _LLMEnv) -> Optional[BaseChatModel]:
+    """GigaChat (Сбер) через langchain-community."""
     try:
         from langchain_community.chat_models.gigachat import GigaChat
 
-        scope = os.getenv("GIGACHAT_SCOPE", "GIGACHAT_API_PERS")
+        scope = cfg.gigachat_scope
         kwargs: dict = {"scope": scope, "verify_ssl_certs": False}
 
-        if credentials:
-            kwargs["credentials"] = credentials
+        if cfg.gigachat_credentials:
+            kwargs["credentials"] = cfg.gigachat_credentials
         else:
-            kwargs["client_id"] = client_id
-            kwargs["client_secret"] = client_secret
+            kwargs["client_id"] = cfg.gigachat_client_id
+            kwargs["client_secret"] = cfg.gigachat_client_secret
 
         llm = GigaChat(**kwargs)
         log.info("LLM-провайдер: GigaChat (scope=%s)", scope)
@@ -55,76 +111,117 @@ def _try_gigachat() -> Optional[BaseChatModel]:
         return None
 
 
-def _try_yandex_gpt() -> Optional[BaseChatModel]:
-    """Yandex GPT через langchain-community."""
-    folder_id = os.getenv("YANDEX_FOLDER_ID")
-    api_key = os.getenv("YANDEX_API_KEY")
-    key_id = os.getenv("YANDEX_KEY_ID")
+def _probe_yandex_gpt(cfg: _LLMEnv) -> bool:
+    return bool(cfg.yandex_folder_id and (cfg.yandex_api_key or cfg.yandex_key_id))
 
-    if not folder_id:
-        return None
-    if not api_key and not key_id:
-        return None
 
+def _build_yandex_gpt(cfg: _LLMEnv) -> Optional[BaseChatModel]:
+    """Yandex GPT через langchain-community."""
     try:
         from langchain_community.chat_models.yandex import ChatYandexGPT
 
-        kwargs: dict = {"folder_id": folder_id}
+        kwargs: dict = {"folder_id": cfg.yandex_folder_id}
 
-        if api_key:
-            kwargs["api_key"] = api_key
+        if cfg.yandex_api_key:
+            kwargs["api_key"] = cfg.yandex_api_key
         else:
             kwargs["iam_token"] = _get_yandex_iam_token()
 
         llm = ChatYandexGPT(**kwargs)
-        log.info("LLM-провайдер: Yandex GPT (folder=%s)", folder_id)
+        log.info("LLM-провайдер: Yandex GPT (folder=%s)", cfg.yandex_folder_id)
         return llm
     except Exception as exc:
         log.warning("Yandex GPT: не удалось инициализировать — %s", exc)
         return None
 
 
-def _get_yandex_iam_token() -> str:
-    """Получение IAM-токена Yandex через JWT сервисного аккаунта."""
-    import time
-    import json
-    import jwt as pyjwt  # PyJWT
+@functools.cache
+def _load_private_key(pem: str):
+    """Разбирает PEM-ключ сервисного аккаунта один раз (RSAPrivateKey из cryptography)."""
+    from cryptography.hazmat.primitives import serialization
+
+    return serialization.load_pem_private_key(pem.encode(), password=None)
+
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _encode_ps256_jwt(payload: dict, private_key_pem: str, key_id: str) -> str:
+    """Формирует JWT с подписью PS256 (RSASSA-PSS + SHA-256), как того требует Yandex IAM."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    header = {"alg": "PS256", "typ": "JWT", "kid": key_id}
+    signing_input = ".".join((
+        _b64url(json.dumps(header, separators=(",", ":")).encode()),
+        _b64url(json.dumps(payload, separators=(",", ":")).encode()),
+    ))
+    signature = _load_private_key(private_key_pem).sign(
+        signing_input.encode("ascii"),
+        padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.DIGEST_LENGTH),
+        hashes.SHA256(),
+    )
+    return f"{signing_input}.{_b64url(signature)}"
+
+
+_IAM_TOKEN_URL = "https://iam.api.cloud.yandex.net/iam/v1/tokens"
+# IAM-токен живёт до 12 ч; Yandex рекомендует обновлять его не реже раза в час
+_IAM_TOKEN_TTL = 3600
+_IAM_TOKEN_REFRESH_MARGIN = 60
+
+_iam_token: Optional[tuple[str, float]] = None  # (токен, время истечения)
+
+
+@functools.cache
+def _iam_client():
+    """Общий httpx.Client для запросов IAM-токена (пул соединений и TLS переиспользуются)."""
     import httpx
 
-    key_id = os.environ["YANDEX_KEY_ID"]
-    sa_id = os.environ["YANDEX_SERVICE_ACCOUNT_ID"]
-    private_key = os.environ["YANDEX_PRIVATE_KEY"]
+    return httpx.Client(timeout=10)
+
+
+def _get_yandex_iam_token() -> str:
+    """Получение IAM-токена Yandex через JWT сервисного аккаунта (с кешированием по TTL)."""
+    global _iam_token
+    if _iam_token is not None and time.time() < _iam_token[1] - _IAM_TOKEN_REFRESH_MARGIN:
+        return _iam_token[0]
+
+    cfg = _env()
+    if not (cfg.yandex_key_id and cfg.yandex_service_account_id and cfg.yandex_private_key):
+        raise KeyError("YANDEX_KEY_ID / YANDEX_SERVICE_ACCOUNT_ID / YANDEX_PRIVATE_KEY")
+    key_id = cfg.yandex_key_id
+    sa_id = cfg.yandex_service_account_id
+    private_key = cfg.yandex_private_key
 
     now = int(time.time())
     payload = {
-        "aud": "https://iam.api.cloud.yandex.net/iam/v1/tokens",
+        "aud": _IAM_TOKEN_URL,
         "iss": sa_id,
         "iat": now,
         "exp": now + 3600,
     }
-    encoded = pyjwt.encode(payload, private_key, algorithm="PS256", headers={"kid": key_id})
+    encoded = _encode_ps256_jwt(payload, private_key, key_id)
 
-    resp = httpx.post(
-        "https://iam.api.cloud.yandex.net/iam/v1/tokens",
-        json={"jwt": encoded},
-        timeout=10,
-    )
+    resp = _iam_client().post(_IAM_TOKEN_URL, json={"jwt": encoded})
     resp.raise_for_status()
-    return resp.json()["iamToken"]
+    token = resp.json()["iamToken"]
+    _iam_token = (token, now + _IAM_TOKEN_TTL)
+    return token
 
 
-def _try_openrouter() -> Optional[BaseChatModel]:
-    """OpenRouter — OpenAI-совместимый API."""
-    api_key = os.getenv("OPENROUTER_API_KEY")
-    if not api_key:
-        return None
+def _probe_openrouter(cfg: _LLMEnv) -> bool:
+    return bool(cfg.openrouter_api_key)
 
+
+def _build_openrouter(cfg: _LLMEnv) -> Optional[BaseChatModel]:
+    """OpenRouter — OpenAI-совместимый API."""
     try:
         from langchain_openai import ChatOpenAI
 
-        model = os.getenv("OPENROUTER_MODEL", "openai/gpt-4o-mini")
+        model = cfg.openrouter_model
         llm = ChatOpenAI(
-            openai_api_key=api_key,
+            openai_api_key=cfg.openrouter_api_key,
             openai_api_base="https://openrouter.ai/api/v1",
             model_name=model,
             temperature=0.3,
@@ -136,18 +233,18 @@ def _try_openrouter() -> Optional[BaseChatModel]:
         return None
 
 
-def _try_openai() -> Optional[BaseChatModel]:
-    """OpenAI напрямую."""
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        return None
+def _probe_openai(cfg: _LLMEnv) -> bool:
+    return bool(cfg.openai_api_key)
+
 
+def _build_openai(cfg: _LLMEnv) -> Optional[BaseChatModel]:
+    """OpenAI напрямую."""
     try:
         from langchain_openai import ChatOpenAI
 
-        model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+        model = cfg.openai_model
         llm = ChatOpenAI(
-            openai_api_key=api_key,
+            openai_api_key=cfg.openai_api_key,
             model_name=model,
             temperature=0.3,
         )
@@ -160,39 +257,81 @@ def _try_openai() -> Optional[BaseChatModel]:
 
 # ─── Публичный API ─────────────────────────────────────────────────────────────
 
-_PROVIDERS = [
-    ("GigaChat", _try_gigachat),
-    ("Yandex GPT", _try_yandex_gpt),
-    ("OpenRouter", _try_openrouter),
-    ("OpenAI", _try_openai),
-]
+_PROVIDERS = (
+    ("GigaChat", _probe_gigachat, _build_gigachat),
+    ("Yandex GPT", _probe_yandex_gpt, _build_yandex_gpt),
+    ("OpenRouter", _probe_openrouter, _build_openrouter),
+    ("OpenAI", _probe_openai, _build_openai),
+)
+
+
+@functools.cache
+def _configured_mask() -> int:
+    """Битовая маска провайдеров с заданными ключами: бит i ↔ _PROVIDERS[i] (младший — приоритетный)."""
+    cfg = _env()
+    mask = 0
+    for i, (_, probe, _) in enumerate(_PROVIDERS):
+        if probe(cfg):
+            mask |= 1 << i
+    return mask
+
+
+def _create_llm() -> BaseChatModel:
+    """Создаёт клиент первого сконфигурированного провайдера по приоритету."""
+    cfg = _env()
+    mask = _configured_mask()
+    while mask:
+        idx = (mask & -mask).bit_length() - 1
+        mask &= mask - 1
+        name, _, build = _PROVIDERS[idx]
+        log.debug("Инициализирую провайдер: %s …", name)
+        llm = build(cfg)
+        if llm is not None:
+            return llm
+
+    raise RuntimeError(
+        "Ни один LLM-провайдер не сконфигурирован. "
+        "Заполните .env — см. .env.example."
+    )
 
 
 def get_llm() -> BaseChatModel:
     """
     Возвращает экземпляр LLM.
 
-    Проверяет провайдеров по приоритету; результат кешируется.
+    Проверяет провайдеров по приоритету; результат кешируется —
+    для текущего event loop, а вне loop — глобально.
     Если ни один провайдер не сконфигурирован — RuntimeError.
     """
     global _cached_llm
-    if _cached_llm is not None:
+    try:
+        loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    if loop is None:
+        if _cached_llm is None:
+            _cached_llm = _create_llm()
         return _cached_llm
 
-    for name, factory in _PROVIDERS:
-        log.debug("Проверяю провайдер: %s …", name)
-        llm = factory()
-        if llm is not None:
-            _cached_llm = llm
-            return llm
+    llm = _loop_llms.get(loop)
+    if llm is None:
+        llm = _create_llm()
+        _loop_llms[loop] = llm
+    return llm
 
-    raise RuntimeError(
-        "Ни один LLM-провайдер не сконфигурирован. "
-        "Заполните .env — см. .env.example."
-    )
+
+async def get_llm_async() -> BaseChatModel:
+    """Асинхронный вариант get_llm(): клиент, привязанный к текущему event loop."""
+    return get_llm()
 
 
 def reset_llm_cache() -> None:
     """Сбросить кеш (полезно при смене ключей в рантайме)."""
-    global _cached_llm
+    global _cached_llm, _iam_token
     _cached_llm = None
+    _loop_llms.clear()
+    _iam_token = None
+    _env.cache_clear()
+    _configured_mask.cache_clear()
+    _load_private_key.cache_clear()
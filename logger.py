@@ -2,37 +2,71 @@
 Единая настройка логирования для всех модулей проекта.
 
 Логи пишутся одновременно в файл (logs/bot.log) и в консоль.
+Логгеры только кладут записи в очередь (QueueHandler); запись на диск
+и в консоль выполняет фоновый поток QueueListener, чтобы не блокировать event loop.
 """
 
 from __future__ import annotations
 
+import atexit
+import functools
 import logging
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 from config import LOG_FILE, LOG_LEVEL
 
 _FORMAT = "%(asctime)s | %(levelname)-8s | %(name)-25s | %(message)s"
 _DATE_FMT = "%Y-%m-%d %H:%M:%S"
 
-_file_handler = RotatingFileHandler(
-    LOG_FILE,
-    maxBytes=10 * 1024 * 1024,  # 10 МБ
-    backupCount=5,
-    encoding="utf-8",
-)
-_file_handler.setFormatter(logging.Formatter(_FORMAT, datefmt=_DATE_FMT))
+# Обработчики создаются при первом вызове get_logger(), а не при импорте модуля
+_handlers: list[logging.Handler] = []
+_listener: QueueListener | None = None
 
-_console_handler = logging.StreamHandler(sys.stdout)
-_console_handler.setFormatter(logging.Formatter(_FORMAT, datefmt=_DATE_FMT))
 
+def _get_handlers() -> list[logging.Handler]:
+    """
+    Возвращает общие обработчики логгеров, создавая их при первом обращении.
 
+    Логгерам отдаётся только QueueHandler; файловый и консольный обработчики
+    обслуживает QueueListener в отдельном потоке.
+    """
+    global _listener
+    if not _handlers:
+        formatter = logging.Formatter(_FORMAT, datefmt=_DATE_FMT)
+
+        LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+        file_handler = RotatingFileHandler(
+            LOG_FILE,
+            maxBytes=10 * 1024 * 1024,  # 10 МБ
+            backupCount=5,
+            encoding="utf-8",
+            delay=True,  # файл открывается при первой записи, а не при создании обработчика
+        )
+        file_handler.setFormatter(formatter)
+
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(formatter)
+
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        _listener = QueueListener(
+            log_queue, file_handler, console_handler, respect_handler_level=True,
+        )
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        _handlers.append(QueueHandler(log_queue))
+    return _handlers
+
+
+@functools.lru_cache(maxsize=None)
 def get_logger(name: str) -> logging.Logger:
-    """Возвращает логгер с общими обработчиками."""
+    """Возвращает логгер с общими обработчиками (кешируется по имени)."""
     logger = logging.getLogger(name)
     if not logger.handlers:
         logger.setLevel(LOG_LEVEL)
-        logger.addHandler(_file_handler)
-        logger.addHandler(_console_handler)
+        for handler in _get_handlers():
+            logger.addHandler(handler)
         logger.propagate = False
     return logger
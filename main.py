@@ -10,21 +10,26 @@ FastAPI-бэкенд бота-консультанта ООО "Завод ВРК
 
 from __future__ import annotations
 
-import json
+import asyncio
+import functools
+import hashlib
 import re
-from collections import defaultdict
 from contextlib import asynccontextmanager
-from typing import Any
+from contextvars import ContextVar
+from typing import Any, AsyncIterator
 
+import orjson
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 
 from config import (
     AC_BASKET_SUBCAT_FILTER,
     ACOUSTIC_STEPS,
     CATEGORY_SLUG_MAP,
+    CORS_ORIGINS,
     DISTRIBUTOR_SUBCAT_FILTER,
     VENT_PARTS_SUBCAT_FILTER,
     FACADE_SERIES,
@@ -39,68 +44,86 @@ from config import (
     MANAGER_CONTACTS,
     PRODUCT_TYPE_STEP,
     SALES_ARGS,
+    SESSION_MAX,
+    SESSION_TTL_SECONDS,
     SLOT_GRILLE_SUBCAT_FILTER,
     SLOT_SERIES,
     SLOT_STEPS,
     STATIC_DIR,
     SUBCATEGORY_RULES,
-    SYSTEM_PROMPT,
+    render_system_prompt,
 )
-from llm_factory import get_llm
+from llm_factory import get_llm, get_llm_async
 from logger import get_logger
 from models import ButtonOption, ChatAction, ChatRequest, ChatResponse
 from scheduler import start_scheduler
-from vector_store import get_collection, reindex_all, search
+from scraper import close_http_client
+from semantic_cache import SemanticCache
+from session_store import Session, close_redis, load_session, redis_enabled, save_session
+from ttl_cache import TTLCache
+from vector_store import collection_count, embed_query, get_collection, reindex_all, search, search_async
 
 log = get_logger(__name__)
 
 # ─── Хранилище сессий ─────────────────────────────────────────────────────────
 
-_sessions: dict[str, dict[str, Any]] = defaultdict(lambda: {
-    "funnel_phase": None,       # None | "product_type" | "scenario" | "detail"
-    "scenario_key": None,
-    "step_idx": 0,
-    "active_filters": {},
-    "history": [],
-    # Smart Routing (grille)
-    "grille_phase": None,       # None | "mount" | "feature" | "done"
-    "allowed_subcats": [],      # допустимые slug подкатегорий
-    "grille_routing": [],       # стек решений [{step, value, subcats_before}]
-    # Detail branch (CSV decision tree)
-    "detail_branch": None,      # "facade" | "indoor" | "slot" | None
-    "detail_step_idx": 0,
-    "detail_answers": {},       # ответы на шаги детальной ветки
-    "detected_intents": {},     # analog, custom, mechanical_vent, budget, premium
-})
+# Не более SESSION_MAX сессий; сессия удаляется после SESSION_TTL_SECONDS простоя.
+# Доступ только из event loop — блокировка не нужна.
+_sessions = TTLCache(maxsize=SESSION_MAX, ttl=SESSION_TTL_SECONDS, sliding=True)
 
 
-def _get_session(session_id: str) -> dict[str, Any]:
-    return _sessions[session_id]
+def _get_session(session_id: str) -> Session:
+    """Возвращает сессию, создавая её при первом обращении."""
+    session = _sessions.get(session_id)
+    if session is None:
+        session = Session()
+        _sessions.set(session_id, session)
+    return session
 
 
 def _reset_funnel(session_id: str) -> None:
     s = _get_session(session_id)
-    s["funnel_phase"] = None
-    s["scenario_key"] = None
-    s["step_idx"] = 0
-    s["active_filters"] = {}
-    s["grille_phase"] = None
-    s["allowed_subcats"] = []
-    s["grille_routing"] = []
-    s["detail_branch"] = None
-    s["detail_step_idx"] = 0
-    s["detail_answers"] = {}
-    s["detected_intents"] = {}
+    s.funnel_phase = None
+    s.scenario_key = None
+    s.step_idx = 0
+    s.active_filters = {}
+    s.grille_phase = None
+    s.allowed_subcats = []
+    s.grille_routing = []
+    s.detail_branch = None
+    s.detail_step_idx = 0
+    s.detail_answers = {}
+    s.detected_intents = {}
 
 
 def _get_scenario(session_id: str) -> dict:
-    key = _get_session(session_id).get("scenario_key") or "_default"
+    key = _get_session(session_id).scenario_key or "_default"
     return FUNNEL_SCENARIOS.get(key, FUNNEL_SCENARIOS["_default"])
 
 
+@functools.cache
+def _scenario_option_labels(scenario_key: str) -> dict[tuple[str, str], str]:
+    """(step_id, filter_value) → подпись варианта для сценария (вместе с выбором типа продукции)."""
+    scenario = FUNNEL_SCENARIOS.get(scenario_key, FUNNEL_SCENARIOS["_default"])
+    labels: dict[tuple[str, str], str] = {}
+    for step in [PRODUCT_TYPE_STEP] + scenario.get("steps", []):
+        for opt in step.get("options", []):
+            labels.setdefault((step["step_id"], opt.get("filter_value")), opt["label"])
+    return labels
+
+
+def _get_option_labels(session_id: str) -> dict[tuple[str, str], str]:
+    return _scenario_option_labels(_get_session(session_id).scenario_key or "_default")
+
+
+# Ответы на первый свободный вопрос сессии: похожий вопрос (косинус ≥ 0.92) получает сохранённый ответ.
+# Кеш общий для всех сессий, поэтому в нём только вопросы без истории диалога
+_answer_cache = SemanticCache(maxsize=512, ttl=3600, threshold=0.92)
+
+
 # ─── Навигация ────────────────────────────────────────────────────────────────
 
-def _make_buttons(step_config: dict) -> list[ButtonOption]:
+def _build_buttons(step_config: dict) -> list[ButtonOption]:
     return [
         ButtonOption(
             label=opt["label"],
@@ -110,9 +133,22 @@ def _make_buttons(step_config: dict) -> list[ButtonOption]:
     ]
 
 
+# Кнопки статических шагов воронки собираются один раз; ключ — id шага (шаги живут в config весь процесс).
+# ChatResponse копирует список при валидации, сами ButtonOption не изменяются — делить их безопасно.
+_STEP_BUTTONS: dict[int, list[ButtonOption]] = {
+    id(step): _build_buttons(step)
+    for step in [PRODUCT_TYPE_STEP, *(st for sc in FUNNEL_SCENARIOS.values() for st in sc["steps"])]
+}
+
+
+def _make_buttons(step_config: dict) -> list[ButtonOption]:
+    buttons = _STEP_BUTTONS.get(id(step_config))
+    return buttons if buttons is not None else _build_buttons(step_config)
+
+
 def _goto_main_menu(session_id: str) -> ChatResponse:
     _reset_funnel(session_id)
-    _get_session(session_id)["funnel_phase"] = "product_type"
+    _get_session(session_id).funnel_phase = "product_type"
     return ChatResponse(
         reply=PRODUCT_TYPE_STEP["question"],
         action=ChatAction.ASK_QUESTION,
@@ -124,12 +160,12 @@ def _current_step_response(session_id: str) -> ChatResponse:
     session = _get_session(session_id)
     scenario = _get_scenario(session_id)
     steps = scenario["steps"]
-    idx = session["step_idx"]
+    idx = session.step_idx
     if idx >= len(steps):
-        session["step_idx"] = max(0, len(steps) - 1)
-        idx = session["step_idx"]
+        session.step_idx = max(0, len(steps) - 1)
+        idx = session.step_idx
     if idx < 0:
-        session["step_idx"] = 0
+        session.step_idx = 0
         idx = 0
     step = steps[idx]
     return ChatResponse(
@@ -144,27 +180,27 @@ def _activate_scenario(session_id: str, scenario_key: str) -> ChatResponse:
     effective_key = scenario_key if scenario_key in FUNNEL_SCENARIOS else "_default"
     scenario = FUNNEL_SCENARIOS[effective_key]
 
-    session["scenario_key"] = effective_key
-    session["funnel_phase"] = "scenario"
-    session["step_idx"] = 0
-    session["grille_phase"] = None
-    session["grille_routing"] = []
+    session.scenario_key = effective_key
+    session.funnel_phase = "scenario"
+    session.step_idx = 0
+    session.grille_phase = None
+    session.grille_routing = []
 
     if scenario_key:
-        session["active_filters"]["product_type"] = scenario_key
+        session.active_filters["product_type"] = scenario_key
 
     for k, v in scenario.get("auto_filters", {}).items():
-        session["active_filters"][k] = v
+        session.active_filters[k] = v
 
     if effective_key == "grille":
-        session["allowed_subcats"] = list(SUBCATEGORY_RULES.keys())
+        session.allowed_subcats = list(SUBCATEGORY_RULES.keys())
     elif effective_key == "slot_grille":
-        session["allowed_subcats"] = [
+        session.allowed_subcats = [
             slug for slug, cat in CATEGORY_SLUG_MAP.items() if cat == "slot_grille"
         ]
     else:
         # Диффузоры, корзины, воздухораспределители, детали — фильтр по подкатегориям не нужен
-        session["allowed_subcats"] = []
+        session.allowed_subcats = []
 
     if not scenario["steps"]:
         return _do_filtered_search_sync(session_id, "")
@@ -256,15 +292,15 @@ def _grille_advance(session_id: str, prefix: str = "") -> ChatResponse:
     переходит к статическим шагам (size_group).
     """
     session = _get_session(session_id)
-    subcats = session["allowed_subcats"]
-    location = session["active_filters"].get("location", "")
-    phase = session["grille_phase"]
+    subcats = session.allowed_subcats
+    location = session.active_filters.get("location", "")
+    phase = session.grille_phase
 
     # ── Шаг: Монтаж (если ещё не пройден) ──
     if phase is None:
         mount_opts = _grille_mount_options(location, subcats)
         if len(mount_opts) > 1:
-            session["grille_phase"] = "mount"
+            session.grille_phase = "mount"
             buttons = [ButtonOption(label=o["label"], value=o["value"]) for o in mount_opts]
             return ChatResponse(
                 reply=prefix + "Как будет выполнен монтаж решетки?",
@@ -273,13 +309,13 @@ def _grille_advance(session_id: str, prefix: str = "") -> ChatResponse:
             )
         elif len(mount_opts) == 1:
             subcats = _filter_subcats_by_mount(subcats, location, mount_opts[0]["value"])
-            session["allowed_subcats"] = subcats
+            session.allowed_subcats = subcats
 
     # ── Шаг: Особенности (если >1 feature осталось) ──
     if phase in (None, "mount_done"):
         feat_opts = _grille_feature_options(subcats)
         if len(feat_opts) > 1:
-            session["grille_phase"] = "feature"
+            session.grille_phase = "feature"
             buttons = [ButtonOption(label=o["label"], value=o["value"]) for o in feat_opts]
             return ChatResponse(
                 reply=prefix + "Какие требования к решетке?",
@@ -288,8 +324,8 @@ def _grille_advance(session_id: str, prefix: str = "") -> ChatResponse:
             )
 
     # ── Routing завершён → к size_group ──
-    session["grille_phase"] = "done"
-    session["step_idx"] = 1  # size_group — steps[1] в grille
+    session.grille_phase = "done"
+    session.step_idx = 1  # size_group — steps[1] в grille
 
     if len(subcats) == 1:
         label = SUBCATEGORY_RULES.get(subcats[0], {}).get("label", "")
@@ -310,32 +346,32 @@ def _grille_advance(session_id: str, prefix: str = "") -> ChatResponse:
 def _grille_handle_answer(session_id: str, message: str) -> ChatResponse:
     """Обрабатывает ответ на динамический шаг Smart Routing."""
     session = _get_session(session_id)
-    phase = session["grille_phase"]
-    location = session["active_filters"].get("location", "")
+    phase = session.grille_phase
+    location = session.active_filters.get("location", "")
 
-    session["grille_routing"].append({
+    session.grille_routing.append({
         "step": phase,
         "value": message,
-        "subcats_before": list(session["allowed_subcats"]),
+        "subcats_before": list(session.allowed_subcats),
     })
 
     if phase == "mount":
-        subcats = _filter_subcats_by_mount(session["allowed_subcats"], location, message)
-        session["allowed_subcats"] = subcats
-        session["grille_phase"] = "mount_done"
+        subcats = _filter_subcats_by_mount(session.allowed_subcats, location, message)
+        session.allowed_subcats = subcats
+        session.grille_phase = "mount_done"
         return _grille_advance(session_id)
 
     if phase == "feature":
-        subcats = _filter_subcats_by_feature(session["allowed_subcats"], message)
-        session["allowed_subcats"] = subcats
+        subcats = _filter_subcats_by_feature(session.allowed_subcats, message)
+        session.allowed_subcats = subcats
         # Фильтр по характеристике с сайта: только Регулируемые или только Нерегулируемые
         if message == "adjustable":
-            session["active_filters"]["regulated"] = "regulated"
+            session.active_filters["regulated"] = "regulated"
         elif message == "fixed":
-            session["active_filters"]["regulated"] = "fixed"
+            session.active_filters["regulated"] = "fixed"
         else:
-            session["active_filters"].pop("regulated", None)
-        session["grille_phase"] = "feature_done"
+            session.active_filters.pop("regulated", None)
+        session.grille_phase = "feature_done"
         return _grille_advance(session_id)
 
     return _grille_advance(session_id)
@@ -344,32 +380,32 @@ def _grille_handle_answer(session_id: str, message: str) -> ChatResponse:
 def _grille_back(session_id: str) -> ChatResponse:
     """Навигация «Назад» внутри Smart Routing."""
     session = _get_session(session_id)
-    routing = session["grille_routing"]
+    routing = session.grille_routing
 
     if routing:
         last = routing.pop()
-        session["allowed_subcats"] = last["subcats_before"]
+        session.allowed_subcats = last["subcats_before"]
         prev_step = last["step"]
 
         if prev_step == "mount":
-            session["grille_phase"] = None
-            session["active_filters"].pop("location", None)
-            session["step_idx"] = 0
+            session.grille_phase = None
+            session.active_filters.pop("location", None)
+            session.step_idx = 0
             return _current_step_response(session_id)
 
         if prev_step == "feature":
-            session["active_filters"].pop("regulated", None)
-            session["grille_phase"] = "mount_done"
+            session.active_filters.pop("regulated", None)
+            session.grille_phase = "mount_done"
             if routing and routing[-1]["step"] == "mount":
-                session["grille_phase"] = "mount"
+                session.grille_phase = "mount"
                 return _grille_advance(session_id)
-            session["grille_phase"] = None
+            session.grille_phase = None
             return _grille_advance(session_id)
 
-    session["grille_phase"] = None
-    session["active_filters"].pop("location", None)
-    session["allowed_subcats"] = list(SUBCATEGORY_RULES.keys())
-    session["step_idx"] = 0
+    session.grille_phase = None
+    session.active_filters.pop("location", None)
+    session.allowed_subcats = list(SUBCATEGORY_RULES.keys())
+    session.step_idx = 0
     return _current_step_response(session_id)
 
 
@@ -378,29 +414,44 @@ def _grille_back(session_id: str) -> ChatResponse:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     log.info("Запуск FastAPI-бэкенда …")
+    # Клиент LLM и коллекция создаются заранее, чтобы первый запрос не ждал подключения.
+    # Обработчики берут их сами: get_llm_async() (кеш клиента на event loop) и vector_store;
+    # здесь запоминается только, настроен ли LLM, — для /health
+    app.state.llm_available = False
     try:
         get_llm()
+        app.state.llm_available = True
     except RuntimeError as exc:
         log.critical(str(exc))
 
-    col = get_collection()
-    if col.count() == 0:
+    get_collection()
+    if collection_count() == 0:
         log.info("ChromaDB пуста — попытка индексации из raw_products.json …")
         reindex_all()
 
     sched = start_scheduler()
     yield
     sched.shutdown(wait=False)
+    await close_http_client()
+    await close_redis()
     log.info("FastAPI-бэкенд остановлен.")
 
 
-app = FastAPI(title="Бот-консультант ВРК", version="4.0.0", lifespan=lifespan)
+app = FastAPI(
+    title="Бот-консультант ВРК",
+    version="4.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+# Сжатие ответов (тексты LLM и карточки товаров); CORS добавлен позже — он внешний слой
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+# Виджет шлёт только POST с JSON без cookies; preflight кешируется браузером на сутки
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type"],
+    max_age=86400,
 )
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
@@ -409,52 +460,53 @@ app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 # УТИЛИТЫ RAG / LLM
 # ═══════════════════════════════════════════════════════════════════════════════
 
+_CONTEXT_ITEM_TMPL = (
+    "--- Товар {i} ---\n{text}\n"
+    "Фильтры: location={location}, product_type={product_type}, size_group={size_group}\n"
+    "Характеристики: {attrs}"
+)
+
+
+def _format_context_item(i: int, r: dict) -> str:
+    meta = r.get("metadata", {})
+    try:
+        raw_attrs = orjson.loads(meta.get("raw_attrs_json", "{}"))
+    except (orjson.JSONDecodeError, TypeError):
+        raw_attrs = {}
+    return _CONTEXT_ITEM_TMPL.format(
+        i=i,
+        text=r["text"],
+        location=meta.get("location", "?"),
+        product_type=meta.get("product_type", "?"),
+        size_group=meta.get("size_group", "?"),
+        attrs=", ".join(map("{0[0]}: {0[1]}".format, raw_attrs.items())) if raw_attrs else "нет данных",
+    )
+
+
 def _build_context(results: list[dict]) -> str:
     if not results:
         return "В базе знаний ничего не найдено по данному запросу."
-    parts = []
-    for i, r in enumerate(results, 1):
-        meta = r.get("metadata", {})
-        raw_json = meta.get("raw_attrs_json", "{}")
-        try:
-            raw_attrs = json.loads(raw_json)
-        except (json.JSONDecodeError, TypeError):
-            raw_attrs = {}
-        attrs_str = ", ".join(f"{k}: {v}" for k, v in raw_attrs.items()) if raw_attrs else "нет данных"
-        parts.append(
-            f"--- Товар {i} ---\n{r['text']}\n"
-            f"Фильтры: location={meta.get('location','?')}, "
-            f"product_type={meta.get('product_type','?')}, "
-            f"size_group={meta.get('size_group','?')}\n"
-            f"Характеристики: {attrs_str}"
-        )
-    return "\n\n".join(parts)
+    return "\n\n".join(_format_context_item(i, r) for i, r in enumerate(results, 1))
 
 
 def _format_active_filters(session_id: str) -> str:
     session = _get_session(session_id)
-    active = session.get("active_filters", {})
+    active = session.active_filters
     if not active:
         return "Не заданы (свободный режим)"
 
-    scenario = _get_scenario(session_id)
-    all_steps = [PRODUCT_TYPE_STEP] + scenario.get("steps", [])
-    step_map = {s["step_id"]: s for s in all_steps}
+    option_labels = _get_option_labels(session_id)
 
     parts = []
     for step_id, value in active.items():
         if not value:
             parts.append(f"{step_id}: не важно")
             continue
-        step_cfg = step_map.get(step_id, {})
-        label = value
-        for opt in step_cfg.get("options", []):
-            if opt.get("filter_value") == value:
-                label = f"{opt['label']} ({value})"
-                break
+        opt_label = option_labels.get((step_id, value))
+        label = f"{opt_label} ({value})" if opt_label else value
         parts.append(f"{step_id}: {label}")
 
-    subcats = session.get("allowed_subcats", [])
+    subcats = session.allowed_subcats
     if subcats and len(subcats) <= 5:
         labels = [SUBCATEGORY_RULES.get(s, {}).get("label", s) for s in subcats]
         parts.append(f"подкатегории: {', '.join(labels)}")
@@ -462,23 +514,67 @@ def _format_active_filters(session_id: str) -> str:
     return ", ".join(parts)
 
 
-async def _ask_llm(user_message: str, session_id: str, context: str) -> str:
-    llm = get_llm()
+# Ответы LLM на одинаковый запрос (промпт + история + сообщение) переиспользуются в течение 5 минут:
+# в воронке по кнопкам разные клиенты часто приходят к одному и тому же итоговому запросу
+_llm_answers = TTLCache(maxsize=1024, ttl=300)
+
+
+def _llm_cache_key(messages: list[dict[str, str]]) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for msg in messages:
+        h.update(msg["role"].encode())
+        h.update(b"\0")
+        h.update(msg["content"].encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+_LLM_ERROR_REPLY = "Извините, произошла техническая ошибка. Попробуйте ещё раз или свяжитесь с менеджером."
+
+# Очередь потокового ответа (/api/chat/stream): сюда уходят фрагменты текста LLM. None — обычный запрос.
+_token_sink: ContextVar[asyncio.Queue[str | None] | None] = ContextVar("_token_sink", default=None)
+
+
+async def _ask_llm(user_message: str, session_id: str, context: str, stream: bool = False) -> str:
+    """
+    Запрос к LLM с историей сессии.
+    stream=True — ответ показывается клиенту: при потоковом запросе фрагменты уходят в _token_sink по мере генерации.
+    """
+    llm = await get_llm_async()
     session = _get_session(session_id)
     filters_text = _format_active_filters(session_id)
-    system_msg = SystemMessage(
-        content=SYSTEM_PROMPT.format(context=context, active_filters=filters_text)
-    )
-    history = session["history"][-20:]
-    messages = [system_msg] + history + [HumanMessage(content=user_message)]
-    try:
-        response: AIMessage = await llm.ainvoke(messages)
-        answer = response.content
-    except Exception as exc:
-        log.error("Ошибка LLM: %s", exc)
-        answer = "Извините, произошла техническая ошибка. Попробуйте ещё раз или свяжитесь с менеджером."
-    session["history"].append(HumanMessage(content=user_message))
-    session["history"].append(AIMessage(content=answer))
+    # История хранится простыми словарями {"role", "content"}; в объекты LangChain их переводит сама модель
+    human = {"role": "user", "content": user_message}
+    messages = [
+        {"role": "system", "content": render_system_prompt(filters_text, context)},
+        *session.history,
+        human,
+    ]
+    sink = _token_sink.get() if stream else None
+    streamed = False
+    cache_key = _llm_cache_key(messages)
+    answer = _llm_answers.get(cache_key)
+    if answer is None:
+        try:
+            if sink is None:
+                response = await llm.ainvoke(messages)
+                answer = response.content
+            else:
+                parts: list[str] = []
+                async for chunk in llm.astream(messages):
+                    if chunk.content:
+                        parts.append(chunk.content)
+                        sink.put_nowait(chunk.content)
+                answer = "".join(parts)
+                streamed = True
+            _llm_answers.set(cache_key, answer)
+        except Exception as exc:
+            log.error("Ошибка LLM: %s", exc)
+            answer = _LLM_ERROR_REPLY
+    if sink is not None and not streamed:
+        sink.put_nowait(answer)  # ответ из кеша или сообщение об ошибке — одним фрагментом
+    session.history.append(human)
+    session.history.append({"role": "assistant", "content": answer})
     return answer
 
 
@@ -541,6 +637,18 @@ def _build_where_filter(
     active_filters: dict[str, str],
     allowed_subcats: list[str] | None = None,
 ) -> dict | None:
+    """where-фильтр ChromaDB по фильтрам воронки (кешируется; результат не изменять)."""
+    # Ключ кеша — только значимые для where фильтры в каноническом порядке: ответы на шаги
+    # воронки (facade_* и т.п.) и порядок их выбора не плодят одинаковых записей кеша
+    signature = tuple(sorted((k, v) for k, v in active_filters.items() if v and k in METADATA_FILTER_KEYS))
+    return _where_from_frozen(signature, tuple(allowed_subcats) if allowed_subcats else ())
+
+
+@functools.lru_cache(maxsize=512)
+def _where_from_frozen(
+    filter_items: tuple[tuple[str, str], ...], allowed_subcats: tuple[str, ...],
+) -> dict | None:
+    active_filters = dict(filter_items)
     conditions = []
     # Поиск в нужном блоке сценария: один фильтр по scenario_block сужает выборку
     scenario_block = _get_scenario_block(active_filters)
@@ -559,7 +667,7 @@ def _build_where_filter(
             continue
         conditions.append({k: {"$eq": v}})
     if allowed_subcats:
-        conditions.append({"category": {"$in": allowed_subcats}})
+        conditions.append({"category": {"$in": list(allowed_subcats)}})
     if not conditions:
         return None
     if len(conditions) == 1:
@@ -604,7 +712,54 @@ def _validate_product(meta: dict, active_filters: dict[str, str]) -> bool:
     return True
 
 
-def _search_with_fallback(
+async def _search(query: str, n_results: int, where: dict | None = None) -> list[dict]:
+    """Поиск в пуле потоков (не блокирует event loop); одновременные запросы уходят в ChromaDB пачкой."""
+    return await search_async(query, n_results=n_results, where=where)
+
+
+# Во сколько раз больше результатов запрашивается без фильтров для ослабления фильтров в Python
+_OVERFETCH_FACTOR = 5
+
+
+def _where_matches(meta: dict, where: dict | None) -> bool:
+    """Проверяет метаданные по where-фильтру ChromaDB ($and / $eq / $in) так же, как сам Chroma."""
+    if not where:
+        return True
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(_where_matches(meta, c) for c in cond):
+                return False
+            continue
+        value = meta.get(key)
+        if "$eq" in cond and value != cond["$eq"]:
+            return False
+        if "$in" in cond and value not in cond["$in"]:
+            return False
+    return True
+
+
+def _from_candidates(
+    candidates: list[dict], where: dict | None, n_results: int, exhaustive: bool,
+) -> list[dict] | None:
+    """
+    Выдача запроса с where, собранная из кандидатов без фильтра (отсортированы по расстоянию).
+    Если совпадений не меньше n_results (или кандидаты — вся коллекция), это и есть top-n
+    запроса с where; иначе None — нужен отдельный запрос в ChromaDB.
+    """
+    matches = [c for c in candidates if _where_matches(c.get("metadata", {}), where)]
+    if len(matches) >= n_results or exhaustive:
+        return matches[:n_results]
+    return None
+
+
+def _accept_tier(filters: dict[str, str] | None, results: list[dict]) -> list[dict]:
+    """Результаты варианта ослабления, прошедшие валидацию (без подкатегорий — как есть)."""
+    if filters is None:
+        return results
+    return [r for r in results if _validate_product(r.get("metadata", {}), filters)]
+
+
+async def _search_with_fallback(
     query: str,
     active_filters: dict[str, str],
     scenario: dict,
@@ -613,7 +768,7 @@ def _search_with_fallback(
     detail_branch: str | None = None,
 ) -> list[dict]:
     where = _build_where_filter(active_filters, allowed_subcats)
-    results = search(query, n_results=n_results, where=where)
+    results = await _search(query, n_results, where)
     validated = [r for r in results if _validate_product(r.get("metadata", {}), active_filters)]
     if validated:
         return validated
@@ -629,24 +784,47 @@ def _search_with_fallback(
         never_relax = {"form", "regulated"}
     step_ids = list(reversed([s["step_id"] for s in scenario.get("steps", [])]))
 
+    # Варианты ослабления: по одному шагу с конца, затем без подкатегорий.
+    # filters=None — вариант без подкатегорий, его выдача не валидируется.
+    tiers: list[tuple[str | None, dict[str, str] | None]] = []
     for key_to_relax in step_ids:
         if key_to_relax in never_relax:
             continue
         if key_to_relax in relaxable:
             relaxable.pop(key_to_relax)
-            relaxed = _build_where_filter(relaxable, allowed_subcats)
-            results = search(query, n_results=n_results, where=relaxed)
-            validated = [r for r in results if _validate_product(r.get("metadata", {}), relaxable)]
-            if validated:
-                log.info("Fallback: убран фильтр '%s', найдено %d", key_to_relax, len(validated))
-                return validated
-
+            tiers.append((key_to_relax, dict(relaxable)))
+    tier_wheres = [_build_where_filter(filters, allowed_subcats) for _, filters in tiers]
     if allowed_subcats and detail_branch != "acoustic":
-        relaxed = _build_where_filter(relaxable)
-        results = search(query, n_results=n_results, where=relaxed)
-        if results:
-            log.info("Fallback: убраны subcategory фильтры, найдено %d", len(results))
-            return results
+        tiers.append((None, None))
+        tier_wheres.append(_build_where_filter(relaxable))
+
+    # Один запрос «с запасом» без фильтров: варианты, для которых среди кандидатов набирается
+    # n_results совпадений, решаются в Python. Остальные (до первого решённого с результатом)
+    # запрашиваются параллельно; побеждает самый строгий вариант с непустым результатом.
+    overfetch_n = n_results * _OVERFETCH_FACTOR
+    candidates = await _search(query, overfetch_n)
+    exhaustive = len(candidates) < overfetch_n  # вернулась вся коллекция
+    tier_results = [_from_candidates(candidates, w, n_results, exhaustive) for w in tier_wheres]
+    unresolved: list[int] = []
+    for i, results in enumerate(tier_results):
+        if results is None:
+            unresolved.append(i)
+        elif _accept_tier(tiers[i][1], results):
+            break
+    fetched = await asyncio.gather(*(_search(query, n_results, tier_wheres[i]) for i in unresolved))
+    for i, results in zip(unresolved, fetched):
+        tier_results[i] = results
+
+    for (key_to_relax, filters), results in zip(tiers, tier_results):
+        if results is None:
+            break
+        accepted = _accept_tier(filters, results)
+        if accepted:
+            if key_to_relax:
+                log.info("Fallback: убран фильтр '%s', найдено %d", key_to_relax, len(accepted))
+            else:
+                log.info("Fallback: убраны subcategory фильтры, найдено %d", len(accepted))
+            return accepted
 
     # Круглые: никогда не возвращать «любые» решётки — только с form=round или пусто
     if active_filters.get("form") == "round":
@@ -654,33 +832,41 @@ def _search_with_fallback(
             {"form": {"$eq": "round"}},
             {"product_type": {"$eq": "grille"}},
         ]}
-        results = search(query, n_results=n_results, where=minimal_where)
+        results = _from_candidates(candidates, minimal_where, n_results, exhaustive)
+        if results is None:
+            results = await _search(query, n_results, minimal_where)
         validated = [r for r in results if _validate_product(r.get("metadata", {}), active_filters)]
         if validated:
             return validated
         return []
 
-    raw = search(query, n_results=n_results)
+    raw = candidates[:n_results]  # top-n без фильтра — начало выдачи «с запасом»
     pt = active_filters.get("product_type", "")
     return [r for r in raw if _validate_product(r.get("metadata", {}), {"product_type": pt})] or raw[:n_results]
 
 
 def _build_search_query(session_id: str) -> str:
     session = _get_session(session_id)
-    scenario = _get_scenario(session_id)
-    all_steps = [PRODUCT_TYPE_STEP] + scenario.get("steps", [])
-    step_map = {s["step_id"]: s for s in all_steps}
+    return _search_query_from_frozen(
+        session.scenario_key or "_default",
+        tuple(session.active_filters.items()),
+        tuple(session.allowed_subcats),
+    )
+
+
+@functools.lru_cache(maxsize=512)
+def _search_query_from_frozen(
+    scenario_key: str, filter_items: tuple[tuple[str, str], ...], subcats: tuple[str, ...],
+) -> str:
+    option_labels = _scenario_option_labels(scenario_key)
     parts = []
-    for step_id, value in session["active_filters"].items():
+    for step_id, value in filter_items:
         if not value:
             continue
-        step_cfg = step_map.get(step_id, {})
-        for opt in step_cfg.get("options", []):
-            if opt.get("filter_value") == value:
-                parts.append(opt["label"])
-                break
+        label = option_labels.get((step_id, value))
+        if label:
+            parts.append(label)
 
-    subcats = session.get("allowed_subcats", [])
     if subcats and len(subcats) <= 3:
         for s in subcats:
             label = SUBCATEGORY_RULES.get(s, {}).get("label", "")
@@ -690,18 +876,18 @@ def _build_search_query(session_id: str) -> str:
     return " ".join(parts) if parts else "вентиляционное оборудование"
 
 
+# Поля карточки товара, которые отдаются клиенту
+_PRODUCT_KEYS = ("name", "article", "price", "url", "category", "location")
+
+
+def _product_from_metadata(meta: dict) -> dict:
+    return {k: meta.get(k, "") for k in _PRODUCT_KEYS}
+
+
 def _best_product_data(results: list[dict]) -> dict | None:
     if not results:
         return None
-    best = results[0]["metadata"]
-    return {
-        "name": best.get("name", ""),
-        "article": best.get("article", ""),
-        "price": best.get("price", ""),
-        "url": best.get("url", ""),
-        "category": best.get("category", ""),
-        "location": best.get("location", ""),
-    }
+    return _product_from_metadata(results[0]["metadata"])
 
 
 def _product_data_list(results: list[dict], n: int = 5) -> list[dict]:
@@ -716,14 +902,7 @@ def _product_data_list(results: list[dict], n: int = 5) -> list[dict]:
         if url in seen_urls:
             continue
         seen_urls.add(url)
-        out.append({
-            "name": meta.get("name", ""),
-            "article": meta.get("article", ""),
-            "price": meta.get("price", ""),
-            "url": url,
-            "category": meta.get("category", ""),
-            "location": meta.get("location", ""),
-        })
+        out.append(_product_from_metadata(meta))
     return out
 
 
@@ -731,16 +910,16 @@ async def _do_filtered_search(session_id: str, user_message: str) -> ChatRespons
     session = _get_session(session_id)
     scenario = _get_scenario(session_id)
     query = user_message or _build_search_query(session_id)
-    subcats = session.get("allowed_subcats") or None
-    if session.get("scenario_key") == "slot_grille" and subcats:
-        subcats = _filter_slot_grille_subcats(subcats, session["active_filters"])
+    subcats = session.allowed_subcats or None
+    if session.scenario_key == "slot_grille" and subcats:
+        subcats = _filter_slot_grille_subcats(subcats, session.active_filters)
     # Детали систем вентиляции (адаптеры и др.): больше результатов — в подкатегориях много позиций
-    n_results = 15 if session.get("scenario_key") == "vent_parts" else 8
-    results = _search_with_fallback(query, session["active_filters"], scenario, subcats, n_results=n_results)
+    n_results = 15 if session.scenario_key == "vent_parts" else 8
+    results = await _search_with_fallback(query, session.active_filters, scenario, subcats, n_results=n_results)
     log.info(
         "Поиск | scenario=%s | filters=%s | subcats=%s | results=%d",
-        session.get("scenario_key", "?"),
-        session["active_filters"],
+        session.scenario_key,
+        session.active_filters,
         subcats[:5] if subcats else "all",
         len(results),
     )
@@ -751,7 +930,7 @@ async def _do_filtered_search(session_id: str, user_message: str) -> ChatRespons
         session_id, context,
     )
     # Детали систем вентиляции: показываем до 10 карточек (адаптеры, КСД и др.)
-    n_products = 10 if session.get("scenario_key") == "vent_parts" else 5
+    n_products = 10 if session.scenario_key == "vent_parts" else 5
     products = _product_data_list(results, n=n_products)
     _reset_funnel(session_id)
     if products:
@@ -778,79 +957,114 @@ def _do_filtered_search_sync(session_id: str, user_message: str) -> ChatResponse
 # РАСПОЗНАВАНИЕ ТЕКСТА
 # ═══════════════════════════════════════════════════════════════════════════════
 
-_SIZE_RE = re.compile(r"(\d+)\s*[×хxXХ]\s*(\d+)")
+# Possessive-квантификаторы: цифры и пробелы не отдаются назад при неудачном совпадении
+_SIZE_RE = re.compile(r"(\d++)\s*+[×хxXХ]\s*+(\d++)")
+_HAS_DIGIT = re.compile(r"\d").search
+_LARGE_SIZE_MM = 1000  # с такой большей стороны размер считается крупным
 
 
-def _extract_filters_from_text(text: str) -> dict[str, str]:
-    lower = text.lower()
-    filters: dict[str, str] = {}
+def _parse_max_side(text: str) -> int | None:
+    """Большая сторона размера вида «600х300» из текста (мм) или None."""
+    if not _HAS_DIGIT(text):
+        return None  # без цифр размера нет — основной шаблон не запускаем
+    m = _SIZE_RE.search(text)
+    return max(int(m.group(1)), int(m.group(2))) if m else None
+
+
+def _keywords(*words: str) -> re.Pattern[str]:
+    """Одна скомпилированная альтернатива по группе подстрок — один проход по тексту вместо any(...)."""
+    return re.compile("|".join(map(re.escape, words)))
+
+
+# Правило: (шаблон, значение фильтра, шаблон-исключение | None).
+# Внутри группы порядок важен: срабатывает первое совпавшее правило (специфичные первее общих).
+_TextRule = tuple[re.Pattern[str], str, re.Pattern[str] | None]
+
+_GRILLE_WORDS = _keywords("решетк", "решётк")
 
-    # Порядок важен: специфичные первее общих
-    if any(w in lower for w in ("адаптер", "шумоглушител", "камера статич")):
-        filters["product_type"] = "vent_parts"
-    elif any(w in lower for w in ("щелев",)):
-        filters["product_type"] = "slot_grille"
-    elif any(w in lower for w in ("корзин", "кондиционер", "кронштейн", "экран для конд")):
-        filters["product_type"] = "ac_basket"
-    elif any(w in lower for w in ("воздухораспределител", "воздухораздат")):
-        filters["product_type"] = "distributor"
-    elif "клапан" in lower and not any(w in lower for w in ("решетк", "решётк")):
-        filters["product_type"] = "vent_parts"
-    elif "диффузор" in lower:
-        filters["product_type"] = "diffuser"
-    elif any(w in lower for w in ("решетк", "решётк")):
-        filters["product_type"] = "grille"
-    elif any(w in lower for w in ("электропривод", "привод")):
-        pass  # excluded
-    elif any(w in lower for w in ("фильтр", "hepa")):
-        pass  # excluded
-
-    if any(w in lower for w in ("фасад", "улиц", "наружн", "уличн", "снаружи", "внешн")):
-        filters["location"] = "outdoor"
-    elif any(w in lower for w in (
+_PRODUCT_TYPE_RULES: tuple[_TextRule, ...] = (
+    (_keywords("адаптер", "шумоглушител", "камера статич"), "vent_parts", None),
+    (_keywords("щелев"), "slot_grille", None),
+    (_keywords("корзин", "кондиционер", "кронштейн", "экран для конд"), "ac_basket", None),
+    (_keywords("воздухораспределител", "воздухораздат"), "distributor", None),
+    (_keywords("клапан"), "vent_parts", _GRILLE_WORDS),
+    (_keywords("диффузор"), "diffuser", None),
+    (_GRILLE_WORDS, "grille", None),
+    # Электроприводы («привод») и фильтры («фильтр», «hepa») не поддерживаются — тип не выставляем
+)
+
+_LOCATION_RULES: tuple[_TextRule, ...] = (
+    (_keywords("фасад", "улиц", "наружн", "уличн", "снаружи", "внешн"), "outdoor", None),
+    (_keywords(
         "помещен", "внутр", "квартир", "офис", "потолок", "потолоч",
         "стен", "комнат", "дом", "кухн", "ванн", "туалет",
         "в пол", "наполн", "межкомнат", "переточн",
-    )):
-        filters["location"] = "indoor"
+    ), "indoor", None),
+)
 
-    m = _SIZE_RE.search(text)
-    if m:
-        max_side = max(int(m.group(1)), int(m.group(2)))
-        filters["size_group"] = "small" if max_side < 1000 else "large"
-    elif any(w in lower for w in ("маленьк", "небольш", "компактн", "мини")):
-        filters["size_group"] = "small"
-    elif any(w in lower for w in ("больш", "крупн", "промышленн")):
-        filters["size_group"] = "large"
-
-    # Smart Routing hints (grille)
-    if any(w in lower for w in ("скрыт", "невидим", "под шпакл", "гипсокартон", "натяжн")):
-        filters["grille_mount"] = "concealed"
-    elif any(w in lower for w in ("напольн", "в пол")):
-        filters["grille_mount"] = "floor"
-    elif any(w in lower for w in ("потолоч", "в потолок")):
-        filters["grille_mount"] = "ceiling_open"
-    elif any(w in lower for w in ("переточн", "переток", "в дверь", "перегород")):
-        filters["grille_mount"] = "transfer"
-
-    if any(w in lower for w in ("акустич", "шумо", "звукоизол")):
-        filters["grille_feature"] = "acoustic"
-    elif "сотов" in lower:
-        filters["grille_feature"] = "honeycomb"
-    elif "сетч" in lower:
-        filters["grille_feature"] = "mesh"
-    elif any(w in lower for w in ("перфорир", "перфорац")):
-        filters["grille_feature"] = "perforated"
-    elif "щелев" in lower:
-        filters["grille_feature"] = "slot"
-    elif any(w in lower for w in ("декоратив", "дизайн")):
-        filters["grille_feature"] = "decorative"
-    elif "люк" in lower:
-        filters["grille_feature"] = "hatch"
-    elif any(w in lower for w in ("инерцион", "обратн")):
-        filters["grille_feature"] = "inertial"
-
-    return filters
+_SIZE_GROUP_RULES: tuple[_TextRule, ...] = (
+    (_keywords("маленьк", "небольш", "компактн", "мини"), "small", None),
+    (_keywords("больш", "крупн", "промышленн"), "large", None),
+)
+
+# Smart Routing hints (grille)
+_GRILLE_MOUNT_RULES: tuple[_TextRule, ...] = (
+    (_keywords("скрыт", "невидим", "под шпакл", "гипсокартон", "натяжн"), "concealed", None),
+    (_keywords("напольн", "в пол"), "floor", None),
+    (_keywords("потолоч", "в потолок"), "ceiling_open", None),
+    (_keywords("переточн", "переток", "в дверь", "перегород"), "transfer", None),
+)
+
+_GRILLE_FEATURE_RULES: tuple[_TextRule, ...] = (
+    (_keywords("акустич", "шумо", "звукоизол"), "acoustic", None),
+    (_keywords("сотов"), "honeycomb", None),
+    (_keywords("сетч"), "mesh", None),
+    (_keywords("перфорир", "перфорац"), "perforated", None),
+    (_keywords("щелев"), "slot", None),
+    (_keywords("декоратив", "дизайн"), "decorative", None),
+    (_keywords("люк"), "hatch", None),
+    (_keywords("инерцион", "обратн"), "inertial", None),
+)
+
+
+def _match_rules(lower: str, rules: tuple[_TextRule, ...]) -> str | None:
+    """Значение первого правила группы, шаблон которого найден в тексте (и не найдено исключение)."""
+    for pattern, value, exclude in rules:
+        if pattern.search(lower) and not (exclude and exclude.search(lower)):
+            return value
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def _extract_filters_cached(lower: str) -> tuple[tuple[str, str], ...]:
+    """Фильтры из нормализованного текста; кешируется — пользователи часто шлют одинаковые фразы."""
+    filters: dict[str, str] = {}
+
+    product_type = _match_rules(lower, _PRODUCT_TYPE_RULES)
+    if product_type:
+        filters["product_type"] = product_type
+
+    location = _match_rules(lower, _LOCATION_RULES)
+    if location:
+        filters["location"] = location
+
+    max_side = _parse_max_side(lower)  # разделитель «х/x» в классе есть в обоих регистрах
+    if max_side is not None:
+        filters["size_group"] = "small" if max_side < _LARGE_SIZE_MM else "large"
+    else:
+        size_group = _match_rules(lower, _SIZE_GROUP_RULES)
+        if size_group:
+            filters["size_group"] = size_group
+
+    grille_mount = _match_rules(lower, _GRILLE_MOUNT_RULES)
+    if grille_mount:
+        filters["grille_mount"] = grille_mount
+
+    grille_feature = _match_rules(lower, _GRILLE_FEATURE_RULES)
+    if grille_feature:
+        filters["grille_feature"] = grille_feature
+
+    return tuple(filters.items())
 
 
 def _validate_extracted(
@@ -859,9 +1073,8 @@ def _validate_extracted(
     valid = dict(extracted)
     warnings: list[str] = []
 
-    m = _SIZE_RE.search(text)
-    if m:
-        max_side = max(int(m.group(1)), int(m.group(2)))
+    max_side = _parse_max_side(text)
+    if max_side is not None:
         max_allowed = scenario.get("max_size_mm", 9999)
         if max_side > max_allowed:
             warnings.append(
@@ -873,27 +1086,69 @@ def _validate_extracted(
     return valid, warnings
 
 
+def _choice_index(options: list[dict], value_key: str, default: str | None = None) -> dict[str, str]:
+    """
+    Ответ кнопкой (значение или подпись варианта) → значение варианта.
+    При совпадении нескольких вариантов побеждает первый — как при линейном переборе options.
+    """
+    index: dict[str, str] = {}
+    for opt in options:
+        value = opt.get(value_key, opt["label"] if default is None else default)
+        if opt.get(value_key) is not None:
+            index.setdefault(opt[value_key], value)
+        index.setdefault(opt["label"], value)
+    return index
+
+
+_PRODUCT_TYPE_CHOICES = _choice_index(PRODUCT_TYPE_STEP["options"], "filter_value")
+
+
+@functools.cache
+def _scenario_step_choices(scenario_key: str, step_idx: int) -> dict[str, str]:
+    """Индекс ответов для шага сценария (значение по умолчанию — "")."""
+    scenario = FUNNEL_SCENARIOS.get(scenario_key, FUNNEL_SCENARIOS["_default"])
+    return _choice_index(scenario["steps"][step_idx].get("options", []), "filter_value", "")
+
+
+@functools.cache
+def _detail_step_choices(branch: str, step_idx: int) -> dict[str, str]:
+    """Индекс ответов для шага детальной ветки."""
+    return _choice_index(_get_detail_steps(branch)[step_idx].get("options", []), "value")
+
+
+_KNOWN_OPTIONS = frozenset(
+    key
+    for step in [PRODUCT_TYPE_STEP, *(st for sc in FUNNEL_SCENARIOS.values() for st in sc["steps"])]
+    for key in _choice_index(step.get("options", []), "filter_value", "")
+)
+
+
 def _is_known_option(message: str) -> bool:
-    for opt in PRODUCT_TYPE_STEP["options"]:
-        if opt.get("filter_value") == message or opt["label"] == message:
-            return True
-    for scenario in FUNNEL_SCENARIOS.values():
-        for step in scenario["steps"]:
+    return message in _KNOWN_OPTIONS
+
+
+def _build_first_step_option_labels() -> dict[tuple[str, str], str]:
+    """
+    (step_id, filter_value) → подпись варианта по всем сценариям за один проход.
+    Для каждого step_id берётся первый встреченный шаг (тип продукции, затем сценарии по порядку).
+    """
+    labels: dict[tuple[str, str], str] = {}
+    seen_steps: set[str] = set()
+    for sc_steps in ([PRODUCT_TYPE_STEP], *(sc["steps"] for sc in FUNNEL_SCENARIOS.values())):
+        for step in sc_steps:
+            step_id = step["step_id"]
+            if step_id in seen_steps:
+                continue
+            seen_steps.add(step_id)
             for opt in step.get("options", []):
-                if opt.get("filter_value") == message or opt["label"] == message:
-                    return True
-    return False
+                labels.setdefault((step_id, opt.get("filter_value")), opt["label"])
+    return labels
 
 
-def _describe_extracted(extracted: dict[str, str]) -> str:
-    all_steps = [PRODUCT_TYPE_STEP]
-    for sc in FUNNEL_SCENARIOS.values():
-        all_steps.extend(sc["steps"])
-    step_map: dict[str, dict] = {}
-    for s in all_steps:
-        if s["step_id"] not in step_map:
-            step_map[s["step_id"]] = s
+_FIRST_STEP_OPTION_LABELS = _build_first_step_option_labels()
 
+
+def _describe_extracted(extracted: dict[str, str]) -> str:
     parts: list[str] = []
     for step_id, value in extracted.items():
         if step_id.startswith("grille_"):
@@ -906,37 +1161,42 @@ def _describe_extracted(extracted: dict[str, str]) -> str:
             elif step_id == "grille_feature":
                 parts.append(GRILLE_FEATURE_LABELS.get(value, value))
             continue
-        cfg = step_map.get(step_id, {})
-        for opt in cfg.get("options", []):
-            if opt.get("filter_value") == value:
-                parts.append(opt["label"])
-                break
-        else:
-            parts.append(value)
+        parts.append(_FIRST_STEP_OPTION_LABELS.get((step_id, value), value))
     return ", ".join(parts)
 
 
-def _is_start_funnel(message: str) -> bool:
-    triggers = [
-        "старт", "начать", "подобрать", "помоги выбрать",
-        "нужна решетка", "нужен диффузор", "хочу купить",
-        "подбор", "каталог", "что есть",
-    ]
-    return any(t in message.lower().strip() for t in triggers)
+_START_FUNNEL_TRIGGERS = frozenset({
+    "старт", "начать", "подобрать", "помоги выбрать",
+    "нужна решетка", "нужен диффузор", "хочу купить",
+    "подбор", "каталог", "что есть",
+})
 
+_CONTACT_TRIGGERS = frozenset({
+    "менеджер", "связаться", "позвонить", "телефон",
+    "контакт", "оператор", "человек",
+})
 
-def _is_contact_request(message: str) -> bool:
-    triggers = [
-        "менеджер", "связаться", "позвонить", "телефон",
-        "контакт", "оператор", "человек",
-    ]
-    return any(t in message.lower().strip() for t in triggers)
+
+# Оба набора триггеров — в одном шаблоне с именованными группами. Lookahead проверяет
+# каждую позицию, поэтому пересекающиеся вхождения разных групп не теряются.
+_TRIGGERS_RE = re.compile(
+    "(?=(?:(?P<start>{})|(?P<contact>{})))".format(
+        "|".join(map(re.escape, sorted(_START_FUNNEL_TRIGGERS))),
+        "|".join(map(re.escape, sorted(_CONTACT_TRIGGERS))),
+    )
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _message_triggers(lower: str) -> frozenset[str]:
+    """Какие группы триггеров ("start", "contact") встречаются в нормализованном сообщении."""
+    return frozenset(m.lastgroup for m in _TRIGGERS_RE.finditer(lower))
 
 
 def _apply_grille_text_routing(session_id: str, extracted: dict[str, str]) -> None:
     """Применяет Smart Routing hints из текста к сессии grille."""
     session = _get_session(session_id)
-    location = extracted.get("location") or session["active_filters"].get("location", "")
+    location = extracted.get("location") or session.active_filters.get("location", "")
     subcats = _filter_subcats_by_location(location) if location else list(SUBCATEGORY_RULES.keys())
 
     mount_hint = extracted.get("grille_mount")
@@ -947,17 +1207,16 @@ def _apply_grille_text_routing(session_id: str, extracted: dict[str, str]) -> No
     if feature_hint:
         subcats = _filter_subcats_by_feature(subcats, feature_hint)
 
-    session["allowed_subcats"] = subcats
-    session["grille_phase"] = "done" if (mount_hint or feature_hint) else None
+    session.allowed_subcats = subcats
+    session.grille_phase = "done" if (mount_hint or feature_hint) else None
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # РАСПОЗНАВАНИЕ НАМЕРЕНИЙ (Intent Recognition)
 # ═══════════════════════════════════════════════════════════════════════════════
 
-def analyze_intent(text: str) -> dict[str, bool]:
-    """Распознаёт специальные намерения из INTENT_TRIGGERS."""
-    lower = text.lower()
+def analyze_intent(lower: str) -> dict[str, bool]:
+    """Распознаёт специальные намерения из INTENT_TRIGGERS (текст уже в нижнем регистре)."""
     intents: dict[str, bool] = {}
     for intent_key, triggers in INTENT_TRIGGERS.items():
         if any(t in lower for t in triggers):
@@ -969,6 +1228,11 @@ def analyze_intent(text: str) -> dict[str, bool]:
 # ДЕТАЛЬНАЯ ВЕТКА (CSV decision tree)
 # ═══════════════════════════════════════════════════════════════════════════════
 
+# Материалы, по которым фильтруются фасадные и акустические решётки
+_FACADE_MATERIALS = frozenset({"aluminum", "galvanized", "stainless_steel"})
+_ACOUSTIC_MATERIALS = frozenset({"aluminum", "galvanized"})
+
+
 def _get_detail_steps(branch: str) -> list[dict]:
     if branch == "facade":
         return FACADE_STEPS
@@ -1002,15 +1266,26 @@ def _detail_step_applicable(step: dict, answers: dict) -> bool:
 def _next_detail_step(session_id: str) -> int | None:
     """Находит индекс следующего неотвеченного и применимого шага."""
     s = _get_session(session_id)
-    steps = _get_detail_steps(s["detail_branch"])
-    answers = s["detail_answers"]
-    for i in range(s["detail_step_idx"], len(steps)):
+    steps = _get_detail_steps(s.detail_branch)
+    answers = s.detail_answers
+    for i in range(s.detail_step_idx, len(steps)):
         step = steps[i]
         if step["step_id"] not in answers and _detail_step_applicable(step, answers):
             return i
     return None
 
 
+@functools.cache
+def _detail_buttons(branch: str, step_idx: int) -> list[ButtonOption]:
+    """Кнопки шага детальной ветки (собираются один раз на шаг)."""
+    step = _get_detail_steps(branch)[step_idx]
+    options = step.get("options", [])
+    # Аккустические решётки: только Алюминий и Оцинкованная сталь (нержавеющей нет в ассортименте)
+    if step.get("step_id") == "acoustic_material":
+        options = [o for o in options if (o.get("value") or "") in _ACOUSTIC_MATERIALS]
+    return [ButtonOption(label=o["label"], value=o.get("value") or o["label"]) for o in options]
+
+
 async def _detail_ask(session_id: str, prefix: str = "") -> ChatResponse:
     """Задаёт следующий вопрос из детальной ветки или завершает поиском."""
     s = _get_session(session_id)
@@ -1018,22 +1293,11 @@ async def _detail_ask(session_id: str, prefix: str = "") -> ChatResponse:
     if idx is None:
         return await _detail_search(session_id)
 
-    s["detail_step_idx"] = idx
-    s["funnel_phase"] = "detail"
-    step = _get_detail_steps(s["detail_branch"])[idx]
-    options = step.get("options", [])
-    # Аккустические решётки: только Алюминий и Оцинкованная сталь (нержавеющей нет в ассортименте)
-    if step.get("step_id") == "acoustic_material":
-        options = [o for o in options if (o.get("value") or "") in ("aluminum", "galvanized")]
-    answers = s.get("detail_answers", {})
+    s.detail_step_idx = idx
+    s.funnel_phase = "detail"
+    step = _get_detail_steps(s.detail_branch)[idx]
     # Для накладной решётки шаг регулировки не показывается (applicable_when_not в config)
-    buttons = [
-        ButtonOption(
-            label=opt["label"],
-            value=opt.get("value") or opt["label"],
-        )
-        for opt in options
-    ]
+    buttons = _detail_buttons(s.detail_branch, idx)
 
     hint = step.get("hint", "")
     if hint:
@@ -1049,9 +1313,9 @@ async def _detail_ask(session_id: str, prefix: str = "") -> ChatResponse:
 def _recommend_series(session_id: str) -> str:
     """Подбирает рекомендуемые серии на основе ответов детальной ветки."""
     s = _get_session(session_id)
-    branch = s["detail_branch"]
-    answers = s["detail_answers"]
-    intents = s.get("detected_intents", {})
+    branch = s.detail_branch
+    answers = s.detail_answers
+    intents = s.detected_intents
     parts: list[str] = []
 
     if branch == "facade":
@@ -1095,67 +1359,67 @@ async def _detail_search(session_id: str) -> ChatResponse:
     """Выполняет поиск после завершения детальной ветки."""
     s = _get_session(session_id)
     # Подставляем в active_filters ответы из детальной ветки, используемые в метаданных ChromaDB
-    if s.get("detail_branch") == "facade":
-        answers = s.get("detail_answers") or {}
+    if s.detail_branch == "facade":
+        answers = s.detail_answers or {}
         regulated_val = answers.get("facade_regulated", "")
 
         # Привязка ответов фасадной ветки к фильтрам и подкатегориям (метаданные ChromaDB)
         if regulated_val == "inertial":
             # Инерционная: только подкатегория «Инерционные» (category = reshetki-inertsionnye)
-            s["allowed_subcats"] = [
+            s.allowed_subcats = [
                 slug for slug, r in SUBCATEGORY_RULES.items()
                 if r.get("feature") == "inertial"
             ]
-            s["active_filters"]["regulated"] = "fixed"
+            s.active_filters["regulated"] = "fixed"
             # Форму/тип монтажа для инерционных не фильтруем — в БД может не быть этих полей по этой подкатегории
-            s["active_filters"].pop("form", None)
+            s.active_filters.pop("form", None)
         elif answers.get("facade_form") == "round":
             # Круглые решётки для фасада: только наружные (не ВКР «в воздуховод»)
-            s["active_filters"]["product_type"] = "grille"
-            s["active_filters"]["location"] = "outdoor"
-            s["active_filters"]["form"] = "round"
-            s["active_filters"]["regulated"] = "fixed"
-            s["active_filters"].pop("material", None)
-            s["active_filters"].pop("round_diameter_group", None)
+            s.active_filters["product_type"] = "grille"
+            s.active_filters["location"] = "outdoor"
+            s.active_filters["form"] = "round"
+            s.active_filters["regulated"] = "fixed"
+            s.active_filters.pop("material", None)
+            s.active_filters.pop("round_diameter_group", None)
         else:
             # Обычные фасадные (встраиваемые/накладные): форма, материал, тип монтажа, регулировка
             form_val = answers.get("facade_form", "")
             if form_val:
-                s["active_filters"]["form"] = form_val
+                s.active_filters["form"] = form_val
             else:
-                s["active_filters"].pop("form", None)
+                s.active_filters.pop("form", None)
             mat = (answers.get("facade_material") or "").strip()
-            if mat in ("aluminum", "galvanized", "stainless_steel"):
-                s["active_filters"]["material"] = mat
+            if mat in _FACADE_MATERIALS:
+                s.active_filters["material"] = mat
             else:
-                s["active_filters"].pop("material", None)
+                s.active_filters.pop("material", None)
             # Накладные: только накладные решётки, регулируемых не бывает
             mount_type = answers.get("facade_mount_type", "")
             if mount_type in ("embedded", "surface"):
-                s["active_filters"]["installation"] = mount_type
+                s.active_filters["installation"] = mount_type
             else:
-                s["active_filters"].pop("installation", None)
+                s.active_filters.pop("installation", None)
             if mount_type == "surface":
-                s["active_filters"]["regulated"] = "fixed"
+                s.active_filters["regulated"] = "fixed"
             elif regulated_val in ("regulated", "fixed"):
-                s["active_filters"]["regulated"] = regulated_val
+                s.active_filters["regulated"] = regulated_val
             else:
-                s["active_filters"].pop("regulated", None)
+                s.active_filters.pop("regulated", None)
             # allowed_subcats уже задан при входе в фасад (outdoor без инерционных) — не трогаем
 
-    elif s.get("detail_branch") == "acoustic":
+    elif s.detail_branch == "acoustic":
         # Акустические решётки: только подкатегория akusticheskie-reshetki и выбранный материал.
         # location и size_group не фильтруем — в каталоге у акустических часто outdoor/unknown и size_group unknown.
-        answers = s.get("detail_answers") or {}
-        s["allowed_subcats"] = ["akusticheskie-reshetki"]
-        s["active_filters"]["product_type"] = "grille"
-        s["active_filters"].pop("location", None)
-        s["active_filters"].pop("size_group", None)
+        answers = s.detail_answers or {}
+        s.allowed_subcats = ["akusticheskie-reshetki"]
+        s.active_filters["product_type"] = "grille"
+        s.active_filters.pop("location", None)
+        s.active_filters.pop("size_group", None)
         mat = (answers.get("acoustic_material") or "").strip()
-        if mat in ("aluminum", "galvanized"):
-            s["active_filters"]["material"] = mat
+        if mat in _ACOUSTIC_MATERIALS:
+            s.active_filters["material"] = mat
         else:
-            s["active_filters"].pop("material", None)
+            s.active_filters.pop("material", None)
 
     recommendation = _recommend_series(session_id)
     query = _build_search_query(session_id)
@@ -1163,16 +1427,16 @@ async def _detail_search(session_id: str) -> ChatResponse:
         query += " " + recommendation.split(":")[1].strip() if ":" in recommendation else ""
 
     scenario = _get_scenario(session_id)
-    subcats = s.get("allowed_subcats") or None
+    subcats = s.allowed_subcats or None
     log.info(
         "Поиск (detail %s) | filters=%s | subcats=%s",
-        s.get("detail_branch", "?"),
-        s["active_filters"],
+        s.detail_branch,
+        s.active_filters,
         subcats[:5] if subcats else "all",
     )
-    results = _search_with_fallback(
-        query, s["active_filters"], scenario, subcats,
-        detail_branch=s.get("detail_branch"),
+    results = await _search_with_fallback(
+        query, s.active_filters, scenario, subcats,
+        detail_branch=s.detail_branch,
     )
     context = _build_context(results)
 
@@ -1206,7 +1470,7 @@ def _handle_special_intent(session_id: str, message: str, intents: dict) -> Chat
                 f"🔍 **Подбор аналога**\n\n{SALES_ARGS['analog_instruction']}\n\n"
                 "Пришлите артикул, фото или чертёж решетки, и мы подберём "
                 "максимально близкий аналог из нашего ассортимента.\n\n"
-                f"Или свяжитесь с менеджером: {MANAGER_CONTACTS['phone']}"
+                f"Или свяжитесь с менеджером: {MANAGER_CONTACTS.phone}"
             ),
             action=ChatAction.CONTACT_MANAGER,
         )
@@ -1218,7 +1482,7 @@ def _handle_special_intent(session_id: str, message: str, intents: dict) -> Chat
                 f"{SALES_ARGS['custom_capabilities']}\n\n"
                 f"• {SALES_ARGS['custom_frame_fast']}\n"
                 f"• {SALES_ARGS['custom_frame_slow']}\n\n"
-                f"Для расчёта свяжитесь с менеджером: {MANAGER_CONTACTS['phone']}"
+                f"Для расчёта свяжитесь с менеджером: {MANAGER_CONTACTS.phone}"
             ),
             action=ChatAction.CONTACT_MANAGER,
         )
@@ -1231,6 +1495,31 @@ def _handle_special_intent(session_id: str, message: str, intents: dict) -> Chat
 # ═══════════════════════════════════════════════════════════════════════════════
 
 async def process_message(request: ChatRequest) -> ChatResponse:
+    """Обрабатывает сообщение; при REDIS_URL сессия загружается из Redis и сохраняется обратно."""
+    if not redis_enabled():
+        return await _process_message(request)
+    stored = await load_session(request.session_id)
+    if stored is not None:
+        _sessions.set(request.session_id, stored)
+    response = await _process_message(request)
+    await save_session(request.session_id, _get_session(request.session_id))
+    return response
+
+
+def _free_retrieve(message: str) -> tuple[Any, dict | None, list[dict], str]:
+    """
+    Свободный вопрос: эмбеддинг, семантический кеш, поиск и контекст — одним заходом в пул потоков.
+    При попадании в кеш поиск не выполняется (results и context пустые).
+    """
+    embedding = embed_query(message)
+    cached = _answer_cache.lookup(embedding)
+    if cached is not None:
+        return embedding, cached, [], ""
+    results = search(message, n_results=5)
+    return embedding, None, results, _build_context(results)
+
+
+async def _process_message(request: ChatRequest) -> ChatResponse:
     session_id = request.session_id
     message = request.message.strip()
     session = _get_session(session_id)
@@ -1240,53 +1529,53 @@ async def process_message(request: ChatRequest) -> ChatResponse:
         return _goto_main_menu(session_id)
 
     if message == "__back__":
-        phase = session["funnel_phase"]
+        phase = session.funnel_phase
 
         if phase == "detail":
-            idx = session["detail_step_idx"]
+            idx = session.detail_step_idx
             if idx > 0:
-                steps = _get_detail_steps(session["detail_branch"])
-                session["detail_answers"].pop(steps[idx - 1]["step_id"], None)
-                session["detail_step_idx"] = idx - 1
+                steps = _get_detail_steps(session.detail_branch)
+                session.detail_answers.pop(steps[idx - 1]["step_id"], None)
+                session.detail_step_idx = idx - 1
                 return await _detail_ask(session_id)
-            session["funnel_phase"] = "scenario"
-            session["detail_branch"] = None
-            session["detail_answers"] = {}
+            session.funnel_phase = "scenario"
+            session.detail_branch = None
+            session.detail_answers = {}
             # Возврат в сценарий: step_idx мог быть за пределами (например grille indoor → detail при step_idx=2)
             scenario = _get_scenario(session_id)
             steps = scenario["steps"]
-            if session["step_idx"] >= len(steps):
-                session["step_idx"] = max(0, len(steps) - 1)
+            if session.step_idx >= len(steps):
+                session.step_idx = max(0, len(steps) - 1)
             return _current_step_response(session_id)
 
         if phase == "scenario":
-            grille_phase = session.get("grille_phase")
+            grille_phase = session.grille_phase
             scenario = _get_scenario(session_id)
 
             if scenario.get("dynamic") and grille_phase in ("mount", "feature"):
                 return _grille_back(session_id)
 
             if scenario.get("dynamic") and grille_phase == "done":
-                idx = session["step_idx"]
+                idx = session.step_idx
                 if idx > 1:
                     prev_step = scenario["steps"][idx - 1]
-                    session["active_filters"].pop(prev_step["step_id"], None)
-                    session["step_idx"] = idx - 1
+                    session.active_filters.pop(prev_step["step_id"], None)
+                    session.step_idx = idx - 1
                     return _current_step_response(session_id)
                 else:
                     return _grille_back(session_id)
 
-            idx = session["step_idx"]
+            idx = session.step_idx
             if idx > 0:
                 prev_step = scenario["steps"][idx - 1]
-                session["active_filters"].pop(prev_step["step_id"], None)
-                session["step_idx"] = idx - 1
+                session.active_filters.pop(prev_step["step_id"], None)
+                session.step_idx = idx - 1
                 return _current_step_response(session_id)
             else:
-                session["active_filters"].pop("product_type", None)
-                session["active_filters"].clear()
-                session["funnel_phase"] = "product_type"
-                session["scenario_key"] = None
+                session.active_filters.pop("product_type", None)
+                session.active_filters.clear()
+                session.funnel_phase = "product_type"
+                session.scenario_key = None
                 return ChatResponse(
                     reply=PRODUCT_TYPE_STEP["question"],
                     action=ChatAction.ASK_QUESTION,
@@ -1294,147 +1583,143 @@ async def process_message(request: ChatRequest) -> ChatResponse:
                 )
         return _goto_main_menu(session_id)
 
+    # Нижний регистр считается один раз и используется всеми разборами текста ниже
+    lower = message.lower()
+    triggers = _message_triggers(lower)
+
     # ── Связь с менеджером ──
-    if _is_contact_request(message):
+    if "contact" in triggers:
         _reset_funnel(session_id)
         return ChatResponse(
             reply=(
                 f"Свяжитесь с нашим менеджером:\n"
-                f"📞 {MANAGER_CONTACTS['phone']}\n"
-                f"📧 {MANAGER_CONTACTS['email']}\n"
-                f"📍 {MANAGER_CONTACTS['address']}\n"
-                f"🕐 {MANAGER_CONTACTS['work_hours']}"
+                f"📞 {MANAGER_CONTACTS.phone}\n"
+                f"📧 {MANAGER_CONTACTS.email}\n"
+                f"📍 {MANAGER_CONTACTS.address}\n"
+                f"🕐 {MANAGER_CONTACTS.work_hours}"
             ),
             action=ChatAction.CONTACT_MANAGER,
         )
 
     # ── Фаза: детальная ветка (CSV) ──
-    if session["funnel_phase"] == "detail":
-        branch = session["detail_branch"]
+    if session.funnel_phase == "detail":
+        branch = session.detail_branch
         steps = _get_detail_steps(branch)
-        idx = session["detail_step_idx"]
+        idx = session.detail_step_idx
         if idx < len(steps):
             step = steps[idx]
-            chosen = None
-            for opt in step.get("options", []):
-                if opt.get("value") == message or opt["label"] == message:
-                    chosen = opt.get("value", message)
-                    break
+            chosen = _detail_step_choices(branch, idx).get(message)
             if chosen is not None:
-                session["detail_answers"][step["step_id"]] = chosen
-                session["detail_step_idx"] = idx + 1
+                session.detail_answers[step["step_id"]] = chosen
+                session.detail_step_idx = idx + 1
                 return await _detail_ask(session_id)
 
     # ── Фаза: выбор категории ──
-    if session["funnel_phase"] == "product_type":
-        for opt in PRODUCT_TYPE_STEP["options"]:
-            if opt["filter_value"] == message or opt["label"] == message:
-                return _activate_scenario(session_id, opt["filter_value"] or "_default")
+    if session.funnel_phase == "product_type":
+        product_type = _PRODUCT_TYPE_CHOICES.get(message)
+        if product_type is not None:
+            return _activate_scenario(session_id, product_type or "_default")
 
     # ── Фаза: шаги сценария ──
-    if session["funnel_phase"] == "scenario":
+    if session.funnel_phase == "scenario":
         scenario = _get_scenario(session_id)
 
-        if scenario.get("dynamic") and session.get("grille_phase") in ("mount", "feature"):
+        if scenario.get("dynamic") and session.grille_phase in ("mount", "feature"):
             return _grille_handle_answer(session_id, message)
 
-        idx = session["step_idx"]
+        idx = session.step_idx
         steps = scenario["steps"]
 
         if idx < len(steps):
             current_step = steps[idx]
-            chosen_value = None
-            for opt in current_step.get("options", []):
-                if opt.get("filter_value") == message or opt["label"] == message:
-                    chosen_value = opt.get("filter_value", "")
-                    break
+            chosen_value = _scenario_step_choices(session.scenario_key or "_default", idx).get(message)
 
             if chosen_value is not None:
-                session["active_filters"][current_step["step_id"]] = chosen_value
+                session.active_filters[current_step["step_id"]] = chosen_value
 
                 # Корзины для кондиционеров: фильтр по подкатегориям (корзины / экраны·панели / кронштейны)
-                if session.get("scenario_key") == "ac_basket" and current_step["step_id"] == "ac_type":
+                if session.scenario_key == "ac_basket" and current_step["step_id"] == "ac_type":
                     all_ac = [s for s, c in CATEGORY_SLUG_MAP.items() if c == "ac_basket"]
-                    session["allowed_subcats"] = AC_BASKET_SUBCAT_FILTER.get(chosen_value, all_ac)
+                    session.allowed_subcats = AC_BASKET_SUBCAT_FILTER.get(chosen_value, all_ac)
 
                 # Воздухораспределители: фильтр по типу (панельные / низкоскоростные / дисковые / для чистых помещений)
-                if session.get("scenario_key") == "distributor" and current_step["step_id"] == "distributor_type":
+                if session.scenario_key == "distributor" and current_step["step_id"] == "distributor_type":
                     all_dist = [s for s, c in CATEGORY_SLUG_MAP.items() if c == "distributor"]
-                    session["allowed_subcats"] = DISTRIBUTOR_SUBCAT_FILTER.get(chosen_value, all_dist)
+                    session.allowed_subcats = DISTRIBUTOR_SUBCAT_FILTER.get(chosen_value, all_dist)
 
                 # Детали систем вентиляции: фильтр по типу (адаптеры / шумоглушители / воздушные клапаны)
-                if session.get("scenario_key") == "vent_parts" and current_step["step_id"] == "part_type":
+                if session.scenario_key == "vent_parts" and current_step["step_id"] == "part_type":
                     all_vp = [s for s, c in CATEGORY_SLUG_MAP.items() if c == "vent_parts"]
-                    session["allowed_subcats"] = VENT_PARTS_SUBCAT_FILTER.get(chosen_value, all_vp)
+                    session.allowed_subcats = VENT_PARTS_SUBCAT_FILTER.get(chosen_value, all_vp)
 
                 if scenario.get("dynamic") and current_step["step_id"] == "location":
                     # Сначала отдельные ветки (acoustic, outdoor, duct), чтобы не попасть в len(subcats)==0
-                    if chosen_value == "acoustic" and session.get("scenario_key") == "grille":
-                        session["detail_branch"] = "acoustic"
-                        session["detail_step_idx"] = 0
-                        session["detail_answers"] = {}
-                        session["allowed_subcats"] = ["akusticheskie-reshetki"]
-                        session["active_filters"]["product_type"] = "grille"
-                        session["active_filters"]["location"] = "indoor"
+                    if chosen_value == "acoustic" and session.scenario_key == "grille":
+                        session.detail_branch = "acoustic"
+                        session.detail_step_idx = 0
+                        session.detail_answers = {}
+                        session.allowed_subcats = ["akusticheskie-reshetki"]
+                        session.active_filters["product_type"] = "grille"
+                        session.active_filters["location"] = "indoor"
                         return await _detail_ask(session_id)
 
                     subcats = _filter_subcats_by_location(chosen_value)
-                    session["allowed_subcats"] = subcats
+                    session.allowed_subcats = subcats
 
                     if len(subcats) == 0:
-                        session["grille_phase"] = "done"
-                        session["step_idx"] = 1
+                        session.grille_phase = "done"
+                        session.step_idx = 1
                         return _current_step_response(session_id)
 
                     # Grille outdoor → FACADE detail branch (только обычные фасадные, без инерционных)
-                    if chosen_value == "outdoor" and session.get("scenario_key") == "grille":
-                        session["detail_branch"] = "facade"
-                        session["detail_step_idx"] = 0
-                        session["detail_answers"] = {}
+                    if chosen_value == "outdoor" and session.scenario_key == "grille":
+                        session.detail_branch = "facade"
+                        session.detail_step_idx = 0
+                        session.detail_answers = {}
                         # Инерционные решётки — только при явном выборе; в ветке «Фасад» исключаем
-                        session["allowed_subcats"] = [
-                            s for s in session["allowed_subcats"]
+                        session.allowed_subcats = [
+                            s for s in session.allowed_subcats
                             if SUBCATEGORY_RULES.get(s, {}).get("feature") != "inertial"
                         ]
                         prefix = SALES_ARGS.get("embedded_vs_surface", "")
                         return await _detail_ask(session_id, f"💡 {prefix}\n\n" if prefix else "")
 
                     # Grille «В воздуховод» — только решётки с формой «Цилиндрические»
-                    if chosen_value == "duct" and session.get("scenario_key") == "grille":
-                        session["active_filters"]["form"] = "cylindrical"
-                        session["grille_phase"] = "done"
-                        session["step_idx"] = 1  # следующий шаг — size_group
-                        session["allowed_subcats"] = list(SUBCATEGORY_RULES.keys())
+                    if chosen_value == "duct" and session.scenario_key == "grille":
+                        session.active_filters["form"] = "cylindrical"
+                        session.grille_phase = "done"
+                        session.step_idx = 1  # следующий шаг — size_group
+                        session.allowed_subcats = list(SUBCATEGORY_RULES.keys())
                         return _current_step_response(session_id)
 
                     return _grille_advance(session_id)
 
-                session["step_idx"] = idx + 1
-                if session["step_idx"] < len(steps):
+                session.step_idx = idx + 1
+                if session.step_idx < len(steps):
                     # After last scenario step for grille indoor → detail branch
                     if (
-                        session.get("scenario_key") == "grille"
-                        and session["step_idx"] >= len(steps)
+                        session.scenario_key == "grille"
+                        and session.step_idx >= len(steps)
                     ):
-                        session["detail_branch"] = "indoor"
-                        session["detail_step_idx"] = 0
-                        session["detail_answers"] = {}
+                        session.detail_branch = "indoor"
+                        session.detail_step_idx = 0
+                        session.detail_answers = {}
                         return await _detail_ask(session_id)
                     return _current_step_response(session_id)
 
                 # All scenario steps done
-                sk = session.get("scenario_key", "")
-                if sk == "grille" and session["active_filters"].get("location") == "indoor":
-                    session["detail_branch"] = "indoor"
-                    session["detail_step_idx"] = 0
-                    session["detail_answers"] = {}
+                sk = session.scenario_key
+                if sk == "grille" and session.active_filters.get("location") == "indoor":
+                    session.detail_branch = "indoor"
+                    session.detail_step_idx = 0
+                    session.detail_answers = {}
                     return await _detail_ask(session_id)
 
                 return await _do_filtered_search(session_id, _build_search_query(session_id))
 
     # ── Распознавание намерений ──
-    intents = analyze_intent(message)
-    session["detected_intents"].update(intents)
+    intents = analyze_intent(lower)
+    session.detected_intents.update(intents)
 
     # Специальные намерения: аналог, нестандарт
     special = _handle_special_intent(session_id, message, intents)
@@ -1442,10 +1727,10 @@ async def process_message(request: ChatRequest) -> ChatResponse:
         return special
 
     # ── Умный анализ свободного текста ──
-    extracted = _extract_filters_from_text(message)
+    extracted = dict(_extract_filters_cached(lower))
 
     if extracted:
-        pt = extracted.get("product_type") or session.get("scenario_key")
+        pt = extracted.get("product_type") or session.scenario_key
         scenario_key = pt or "_default"
         scenario = FUNNEL_SCENARIOS.get(scenario_key, FUNNEL_SCENARIOS["_default"])
 
@@ -1466,22 +1751,22 @@ async def process_message(request: ChatRequest) -> ChatResponse:
             )
 
         if "product_type" in valid_filters and valid_filters["product_type"]:
-            session["scenario_key"] = valid_filters["product_type"]
-            session["active_filters"]["product_type"] = valid_filters["product_type"]
+            session.scenario_key = valid_filters["product_type"]
+            session.active_filters["product_type"] = valid_filters["product_type"]
             scenario = _get_scenario(session_id)
             for k, v in scenario.get("auto_filters", {}).items():
                 if k not in valid_filters:
-                    session["active_filters"][k] = v
+                    session.active_filters[k] = v
 
         for key, value in valid_filters.items():
             if key != "product_type" and not key.startswith("grille_"):
-                session["active_filters"][key] = value
+                session.active_filters[key] = value
 
-        if session.get("scenario_key") == "grille":
+        if session.scenario_key == "grille":
             if "grille_mount" in extracted or "grille_feature" in extracted:
                 _apply_grille_text_routing(session_id, extracted)
             elif "location" in valid_filters:
-                session["allowed_subcats"] = _filter_subcats_by_location(valid_filters["location"])
+                session.allowed_subcats = _filter_subcats_by_location(valid_filters["location"])
 
         # Mechanical vent trigger → inject sales arg
         if intents.get("mechanical_vent"):
@@ -1493,24 +1778,24 @@ async def process_message(request: ChatRequest) -> ChatResponse:
 
         next_idx = None
         for i, sid in enumerate(step_ids):
-            if sid not in session["active_filters"]:
+            if sid not in session.active_filters:
                 next_idx = i
                 break
 
         is_grille_routing_done = (
-            session.get("scenario_key") == "grille"
-            and session.get("grille_phase") == "done"
+            session.scenario_key == "grille"
+            and session.grille_phase == "done"
         )
 
         if next_idx is not None:
-            if session.get("scenario_key") == "grille" and not is_grille_routing_done:
+            if session.scenario_key == "grille" and not is_grille_routing_done:
                 if next_idx == 0:
                     pass
-                elif next_idx >= 1 and session.get("grille_phase") != "done":
+                elif next_idx >= 1 and session.grille_phase != "done":
                     return _grille_advance(session_id)
 
-            session["funnel_phase"] = "scenario"
-            session["step_idx"] = next_idx
+            session.funnel_phase = "scenario"
+            session.step_idx = next_idx
             step_cfg = steps[next_idx]
 
             warning_prefix = "\n".join(f"⚠️ {w}" for w in warnings)
@@ -1528,60 +1813,82 @@ async def process_message(request: ChatRequest) -> ChatResponse:
             )
 
         # Grille text → activate detail branch
-        loc = session["active_filters"].get("location", "")
-        sk = session.get("scenario_key", "")
-        if sk == "grille" and loc == "outdoor" and not session.get("detail_branch"):
-            session["detail_branch"] = "facade"
-            session["detail_step_idx"] = 0
-            session["detail_answers"] = {}
+        loc = session.active_filters.get("location", "")
+        sk = session.scenario_key
+        if sk == "grille" and loc == "outdoor" and not session.detail_branch:
+            session.detail_branch = "facade"
+            session.detail_step_idx = 0
+            session.detail_answers = {}
             # В ветке «Фасад» только обычные фасадные, без инерционных
-            subcats = session.get("allowed_subcats") or _filter_subcats_by_location("outdoor")
-            session["allowed_subcats"] = [
+            subcats = session.allowed_subcats or _filter_subcats_by_location("outdoor")
+            session.allowed_subcats = [
                 s for s in subcats
                 if SUBCATEGORY_RULES.get(s, {}).get("feature") != "inertial"
             ]
             return await _detail_ask(session_id)
-        if sk == "grille" and loc == "indoor" and not session.get("detail_branch"):
-            session["detail_branch"] = "indoor"
-            session["detail_step_idx"] = 0
-            session["detail_answers"] = {}
+        if sk == "grille" and loc == "indoor" and not session.detail_branch:
+            session.detail_branch = "indoor"
+            session.detail_step_idx = 0
+            session.detail_answers = {}
             return await _detail_ask(session_id)
 
         return await _do_filtered_search(session_id, message)
 
     # ── Триггеры начала воронки ──
-    if _is_start_funnel(message) and session["funnel_phase"] is None:
+    if "start" in triggers and session.funnel_phase is None:
         return _goto_main_menu(session_id)
 
     # ── Свободный вопрос (RAG) ──
-    results = search(message, n_results=5)
-    context = _build_context(results)
-    llm_answer = await _ask_llm(message, session_id, context)
+    # Семантический кеш — только для первого, самостоятельного вопроса: ответ LLM строится с учётом
+    # истории сессии, и на уточнение («а сколько стоит?») ответ из чужого диалога не подходит
+    use_cache = session.funnel_phase is None and not session.active_filters and not session.history
+    embedding = None
+    if use_cache:
+        embedding, cached, results, context = await asyncio.to_thread(_free_retrieve, message)
+        if cached is not None:
+            log.info("Семантический кеш: ответ на похожий вопрос")
+            response = ChatResponse.model_validate(cached)
+            session.history.append({"role": "user", "content": message})
+            session.history.append({"role": "assistant", "content": response.reply})
+            return response
+    else:
+        results = await _search(message, 5)
+        context = _build_context(results)
+
+    in_funnel = session.funnel_phase in ("product_type", "scenario", "detail")
+    if not in_funnel and results and results[0]["distance"] < 0.7:
+        # Близкие товары — ответ списком, без LLM: иначе клиент потока увидел бы текст,
+        # который итоговое событие done заменит списком товаров
+        response = ChatResponse(
+            reply="Вот решетки которые вам могут подойти:",
+            action=ChatAction.SHOW_PRODUCT,
+            products=_product_data_list(results, n=5),
+        )
+        session.history.append({"role": "user", "content": message})
+        session.history.append({"role": "assistant", "content": response.reply})
+        if use_cache:
+            # Список, найденный по первому вопросу, не отдаём уточнению из другого диалога
+            _answer_cache.put(embedding, response.model_dump(mode="json"))
+        return response
+
+    llm_answer = await _ask_llm(message, session_id, context, stream=True)
 
-    if session["funnel_phase"] in ("product_type", "scenario", "detail"):
-        if session["funnel_phase"] == "product_type":
+    if in_funnel:
+        if session.funnel_phase == "product_type":
             step_cfg = PRODUCT_TYPE_STEP
-        elif session["funnel_phase"] == "detail":
+        elif session.funnel_phase == "detail":
             idx = _next_detail_step(session_id)
             if idx is not None:
-                branch_steps = _get_detail_steps(session["detail_branch"])
-                step_cfg = branch_steps[idx]
-                opts = step_cfg.get("options", [])
-                if step_cfg.get("step_id") == "acoustic_material":
-                    opts = [o for o in opts if (o.get("value") or "") in ("aluminum", "galvanized")]
-                buttons = [
-                    ButtonOption(label=o["label"], value=o.get("value") or o["label"])
-                    for o in opts
-                ]
+                step_cfg = _get_detail_steps(session.detail_branch)[idx]
                 return ChatResponse(
                     reply=llm_answer + f"\n\n{step_cfg['question']}",
                     action=ChatAction.ASK_QUESTION,
-                    buttons=buttons,
+                    buttons=_detail_buttons(session.detail_branch, idx),
                 )
             step_cfg = PRODUCT_TYPE_STEP
         else:
             scenario = _get_scenario(session_id)
-            idx = session["step_idx"]
+            idx = session.step_idx
             step_cfg = scenario["steps"][idx] if idx < len(scenario["steps"]) else PRODUCT_TYPE_STEP
         return ChatResponse(
             reply=llm_answer + f"\n\n{step_cfg['question']}",
@@ -1589,37 +1896,85 @@ async def process_message(request: ChatRequest) -> ChatResponse:
             buttons=_make_buttons(step_cfg),
         )
 
-    if results and results[0]["distance"] < 0.7:
-        products = _product_data_list(results, n=5)
-        return ChatResponse(
-            reply="Вот решетки которые вам могут подойти:",
-            action=ChatAction.SHOW_PRODUCT,
-            products=products,
-        )
-    return ChatResponse(reply=llm_answer, action=ChatAction.ASK_QUESTION)
+    response = ChatResponse(reply=llm_answer, action=ChatAction.ASK_QUESTION)
+    if use_cache and llm_answer != _LLM_ERROR_REPLY:
+        _answer_cache.put(embedding, response.model_dump(mode="json"))
+    return response
 
 
 # ─── API Endpoints ─────────────────────────────────────────────────────────────
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest) -> ChatResponse:
+@app.post("/api/chat", response_model=ChatResponse, response_class=ORJSONResponse)
+async def chat_endpoint(request: ChatRequest) -> ORJSONResponse:
     log.info("Запрос [%s] session=%s: %s", request.source, request.session_id[:8], request.message[:100])
     response = await process_message(request)
     log.info("Ответ [%s] action=%s: %s", request.source, response.action.value, response.reply[:100])
-    return response
+    # Ответ уже провалидирован моделью — отдаём его orjson напрямую, минуя повторную проверку и jsonable_encoder
+    return ORJSONResponse(response.model_dump(mode="json"))
+
+
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest) -> StreamingResponse:
+    """
+    Тот же диалог, что и /api/chat, в формате Server-Sent Events: пока LLM генерирует ответ
+    на свободный вопрос, приходят события token, в конце — событие done с полным ChatResponse.
+    reply в done начинается ровно с переданного потоком текста (в воронке к нему добавлен вопрос шага);
+    ответ списком товаров LLM не вызывает и приходит только в done.
+    """
+    log.info("Запрос [%s] stream session=%s: %s", request.source, request.session_id[:8], request.message[:100])
+    return StreamingResponse(_stream_chat(request), media_type="text/event-stream")
+
+
+async def _stream_chat(request: ChatRequest) -> AsyncIterator[str]:
+    queue: asyncio.Queue[str | None] = asyncio.Queue()
+
+    async def run() -> ChatResponse:
+        _token_sink.set(queue)  # контекст задачи — копия, на другие запросы не влияет
+        try:
+            return await process_message(request)
+        finally:
+            queue.put_nowait(None)
+
+    task = asyncio.create_task(run())
+    try:
+        while (chunk := await queue.get()) is not None:
+            yield f"event: token\ndata: {orjson.dumps({'text': chunk}).decode()}\n\n"
+        response = await task
+    finally:
+        task.cancel()  # клиент отключился — не продолжаем обработку впустую
+    log.info("Ответ [%s] stream action=%s: %s", request.source, response.action.value, response.reply[:100])
+    yield f"event: done\ndata: {response.model_dump_json()}\n\n"
 
 
 @app.get("/health")
 async def health_check() -> dict:
-    col = get_collection()
-    llm_ok = True
-    try:
-        get_llm()
-    except RuntimeError:
-        llm_ok = False
-    return {"status": "ok", "llm_available": llm_ok, "chroma_documents": col.count()}
+    # Число документов кешируется в vector_store — частые пробы /health не ходят в SQLite;
+    # при промахе запрос к SQLite идёт вне event loop
+    count = await asyncio.to_thread(collection_count)
+    return {
+        "status": "ok",
+        "llm_available": app.state.llm_available,
+        "chroma_documents": count,
+    }
 
 
 if __name__ == "__main__":
+    import os
+
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+
+    dev = bool(os.getenv("DEV"))
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1 and not redis_enabled():
+        # Сессии в памяти у каждого воркера свои — без Redis диалог «терялся» бы между запросами
+        log.warning("WEB_CONCURRENCY=%d без REDIS_URL — запуск в одном воркере", workers)
+        workers = 1
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",        # uvloop, если установлен (uvicorn[standard], кроме Windows)
+        http="httptools",
+        reload=dev,
+        workers=1 if dev else workers,
+    )
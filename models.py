@@ -37,10 +37,16 @@ class Product(BaseModel):
         default_factory=list,
         description="Метки: Хит, Акция, Новинка и т.д.",
     )
+    raw_attrs_json: str = Field(
+        default="",
+        description="raw_attrs, сериализованные в JSON один раз при парсинге (для метаданных ChromaDB)",
+    )
     content_hash: str = Field(
         default="",
-        description="MD5-хеш ключевых полей для отслеживания изменений",
+        description="Хеш ключевых полей для отслеживания изменений",
     )
+    etag: Optional[str] = Field(None, description="ETag страницы товара (для условного запроса)")
+    last_modified: Optional[str] = Field(None, description="Last-Modified страницы товара")
 
 
 # ─── API: запрос / ответ ──────────────────────────────────────────────────────
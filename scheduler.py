@@ -14,7 +14,7 @@ from apscheduler.triggers.cron import CronTrigger
 
 from config import SCRAPER_CRON_DAY_OF_WEEK, SCRAPER_CRON_HOUR, SCRAPER_CRON_MINUTE
 from logger import get_logger
-from scraper import process_to_chunks, run_delta_update
+from scraper import close_http_client, process_to_chunks, run_delta_update
 from vector_store import index_chunks, remove_by_ids
 
 log = get_logger(__name__)
@@ -34,10 +34,10 @@ async def scheduled_scrape_job() -> None:
     try:
         report = await run_delta_update()
 
-        changed_ids = report["added"] + report["updated"]
+        changed_ids = set(report["added"]) | set(report["updated"])
         if changed_ids:
-            chunks = process_to_chunks()
-            relevant = [c for c in chunks if c["id"] in set(changed_ids)]
+            # Чанки строятся только для изменённых товаров — остальные не собираются вовсе
+            relevant = process_to_chunks(only_articles=changed_ids)
             index_chunks(relevant)
             log.info("Проиндексировано %d новых/изменённых товаров", len(relevant))
 
@@ -86,5 +86,6 @@ if __name__ == "__main__":
     async def _manual_run():
         log.info("Ручной запуск парсера …")
         await scheduled_scrape_job()
+        await close_http_client()
 
     asyncio.run(_manual_run())
@@ -12,6 +12,7 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import hashlib
 import json
 import random
@@ -19,7 +20,9 @@ import re
 from typing import Optional
 
 import httpx
-from bs4 import BeautifulSoup
+import lxml.html
+import orjson
+from lxml import etree
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
 from config import (
@@ -27,9 +30,11 @@ from config import (
     CATEGORY_SLUG_MAP,
     MAIN_CATEGORIES,
     RAW_PRODUCTS_PATH,
+    SCRAPER_CONCURRENCY,
     SCRAPER_MAX_RETRIES,
     SCRAPER_REQUEST_DELAY,
     SCRAPER_TIMEOUT,
+    SCRAPER_VALIDATE_ON_LOAD,
     SCRAPER_REMOVE_MISSING,
     START_URLS,
 )
@@ -50,30 +55,107 @@ _HEADERS = {
 }
 
 
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """HTTP-клиент парсера (один на процесс): HTTP/2, keep-alive между запусками, общие заголовки и таймаут."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=True,
+            headers=_HEADERS,
+            timeout=SCRAPER_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=SCRAPER_CONCURRENCY,
+                max_keepalive_connections=SCRAPER_CONCURRENCY,
+            ),
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
 @retry(
     stop=stop_after_attempt(SCRAPER_MAX_RETRIES),
     wait=wait_exponential(min=2, max=30),
     retry=retry_if_exception_type((httpx.HTTPError, httpx.TimeoutException)),
     reraise=True,
 )
-async def _fetch(client: httpx.AsyncClient, url: str) -> str:
-    """Загружает HTML-страницу с повторами при ошибках сети."""
-    resp = await client.get(url, headers=_HEADERS, timeout=SCRAPER_TIMEOUT, follow_redirects=True)
-    resp.raise_for_status()
-    return resp.text
+async def _fetch(url: str, headers: dict[str, str] | None = None) -> httpx.Response:
+    """Загружает страницу с повторами при ошибках сети (304 на условный запрос — не ошибка)."""
+    resp = await _get_client().get(url, headers=headers)
+    # raise_for_status в httpx считает ошибкой любой не-2xx ответ, включая 304
+    if resp.status_code != 304:
+        resp.raise_for_status()
+    return resp
+
+
+def _conditional_headers(product: Product | None) -> dict[str, str] | None:
+    """If-None-Match / If-Modified-Since по сохранённым заголовкам страницы товара."""
+    if product is None:
+        return None
+    headers = {}
+    if product.etag:
+        headers["If-None-Match"] = product.etag
+    if product.last_modified:
+        headers["If-Modified-Since"] = product.last_modified
+    return headers or None
 
 
 # ─── Утилиты ───────────────────────────────────────────────────────────────────
 
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+_CLEAN_CACHE_MAX_LEN = 256  # длинные тексты (описания) уникальны — в кеш не кладём
+
+
 def _clean(text: str | None) -> str:
     """Убирает лишние пробелы и невидимые символы."""
     if not text:
         return ""
-    return re.sub(r"\s+", " ", text).strip()
+    if len(text) > _CLEAN_CACHE_MAX_LEN:
+        return _WHITESPACE_RE.sub(" ", text).strip()
+    # str(): результаты lxml — «умные» строки со ссылкой на элемент, в ключе кеша они держали бы всё дерево
+    return _clean_short(str(text))
+
+
+@functools.lru_cache(maxsize=4096)
+def _clean_short(text: str) -> str:
+    """Короткие строки (подписи, названия полей, цены) на сайте повторяются — очищаем один раз."""
+    return _WHITESPACE_RE.sub(" ", text).strip()
 
 
 def _content_hash(product: Product) -> str:
-    """MD5 от ключевых полей — для отслеживания изменений (в т.ч. смена категории)."""
+    """
+    Хеш ключевых полей — для отслеживания изменений (в т.ч. смена категории).
+    Поля подаются в хеш по очереди, без промежуточной строки и JSON.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for value in (product.name, product.price, product.description, product.category):
+        h.update((value or "").encode())
+        h.update(b"\x1f")
+    for attrs in (product.raw_attrs, product.filters):
+        for k, v in sorted(attrs.items()):
+            h.update(k.encode())
+            h.update(b"\x1e")
+            h.update(v.encode())
+            h.update(b"\x1d")
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+# ─── Совместимость с данными до перехода на blake2b ───────────────────────────
+
+def _legacy_content_hash(product: Product) -> str:
+    """Прежний MD5-хеш полей — только для сверки с raw_products, сохранённым старой версией."""
     blob = "|".join([
         product.name,
         product.price or "",
@@ -85,6 +167,19 @@ def _content_hash(product: Product) -> str:
     return hashlib.md5(blob.encode()).hexdigest()
 
 
+def _adopt_legacy_article(product: Product, old: Product) -> None:
+    """
+    Товар без артикула раньше получал ID md5(url)[:8], теперь blake2b(url).
+    Если старая запись хранит прежний ID — оставляем его, чтобы не пересоздавать документ в ChromaDB.
+    """
+    url = product.url.encode()
+    if (
+        product.article == hashlib.blake2b(url, digest_size=4).hexdigest()
+        and old.article == hashlib.md5(url).hexdigest()[:8]
+    ):
+        product.article = old.article
+
+
 def _abs_url(href: str) -> str:
     """Преобразует относительную ссылку в абсолютную."""
     if href.startswith("http"):
@@ -96,97 +191,95 @@ def _abs_url(href: str) -> str:
 # НОРМАЛИЗАЦИЯ АТРИБУТОВ → ФИЛЬТРЫ
 # ═══════════════════════════════════════════════════════════════════════════════
 
+def _keywords(*words: str) -> re.Pattern[str]:
+    """Одна скомпилированная альтернатива по группе подстрок — один проход по тексту вместо цикла `kw in text`."""
+    return re.compile("|".join(map(re.escape, words)))
+
+
+def _first_code(lower: str, rules: tuple[tuple[re.Pattern[str], str], ...], default: str) -> str:
+    """Код первого правила, шаблон которого найден в тексте."""
+    for pattern, code in rules:
+        if pattern.search(lower):
+            return code
+    return default
+
+
 # Порядок проверки важен: сначала уточнённые материалы, потом общий metal
-_MATERIAL_STAINLESS_KW = ["нержавеющая сталь", "нержавейка", "нержав"]
-_MATERIAL_GALVANIZED_KW = ["оцинковка", "оцинкованная сталь", "оцинкован"]
-_MATERIAL_ALUMINUM_KW = ["алюминий", "алюминиев"]
-_MATERIAL_METAL_OTHER_KW = ["сталь", "металл", "латунь", "медь"]
-_MATERIAL_PLASTIC_KW = ["пластик", "пвх", "полипропилен", "abs", "полистирол"]
-_MATERIAL_WOOD_KW = ["дерево", "деревянный", "мдф", "шпон"]
+_MATERIAL_RULES = (
+    (_keywords("нержавеющая сталь", "нержавейка", "нержав"), "stainless_steel"),
+    (_keywords("оцинковка", "оцинкованная сталь", "оцинкован"), "galvanized"),
+    (_keywords("алюминий", "алюминиев"), "aluminum"),
+    (_keywords("сталь", "металл", "латунь", "медь"), "metal"),
+    (_keywords("пластик", "пвх", "полипропилен", "abs", "полистирол"), "plastic"),
+    (_keywords("дерево", "деревянный", "мдф", "шпон"), "wood"),
+)
 
 
 def _normalize_material(raw_value: str) -> str:
     """Маппинг сырого значения материала в код фильтра: aluminum, galvanized, stainless_steel, metal, plastic, wood, unknown."""
     if not raw_value or not raw_value.strip():
         return "unknown"
-    lower = raw_value.lower()
-    for kw in _MATERIAL_STAINLESS_KW:
-        if kw in lower:
-            return "stainless_steel"
-    for kw in _MATERIAL_GALVANIZED_KW:
-        if kw in lower:
-            return "galvanized"
-    for kw in _MATERIAL_ALUMINUM_KW:
-        if kw in lower:
-            return "aluminum"
-    for kw in _MATERIAL_METAL_OTHER_KW:
-        if kw in lower:
-            return "metal"
-    for kw in _MATERIAL_PLASTIC_KW:
-        if kw in lower:
-            return "plastic"
-    for kw in _MATERIAL_WOOD_KW:
-        if kw in lower:
-            return "wood"
-    return "unknown"
-
-
-_LOCATION_OUTDOOR_KW = [
-    "наружное", "наружный", "для фасада", "на фасад", "фасад",
-    "уличный", "с улицы", "улица",
-]
-_LOCATION_INDOOR_KW = [
-    "внутреннее", "внутренний", "для помещений", "помещение",
-    "внутрь", "в стены", "в потолок", "в пол",
-]
+    return _first_code(raw_value.lower(), _MATERIAL_RULES, "unknown")
+
+
+_LOCATION_RULES = (
+    (_keywords(
+        "наружное", "наружный", "для фасада", "на фасад", "фасад",
+        "уличный", "с улицы", "улица",
+    ), "outdoor"),
+    (_keywords(
+        "внутреннее", "внутренний", "для помещений", "помещение",
+        "внутрь", "в стены", "в потолок", "в пол",
+    ), "indoor"),
+)
 
 
 def _normalize_location(raw_value: str) -> str:
     """Маппинг места установки в код фильтра."""
-    lower = raw_value.lower()
-    for kw in _LOCATION_OUTDOOR_KW:
-        if kw in lower:
-            return "outdoor"
-    for kw in _LOCATION_INDOOR_KW:
-        if kw in lower:
-            return "indoor"
-    return "unknown"
+    return _first_code(raw_value.lower(), _LOCATION_RULES, "unknown")
+
+
+# Ключевое слово → тип изделия; порядок — приоритет (первое в списке важнее независимо от позиции в тексте)
+_PRODUCT_TYPE_KEYWORDS = (
+    ("диффузор", "diffuser"),
+    ("клапан", "valve"),
+    ("решетка", "grille"),
+    ("решётка", "grille"),
+    ("воздухораспределител", "distributor"),
+    ("электропривод", "actuator"),
+    ("фильтр", "filter"),
+    ("hepa", "filter"),
+    ("корзин", "ac_basket"),
+    ("шумоглушител", "silencer"),
+)
+_PRODUCT_TYPE_RANK = {kw: (rank, code) for rank, (kw, code) in enumerate(_PRODUCT_TYPE_KEYWORDS)}
+# Опережающая проверка находит и перекрывающиеся вхождения («фильтрешетка» → фильтр и решетка)
+_PRODUCT_TYPE_RE = re.compile("(?=(" + "|".join(re.escape(kw) for kw, _ in _PRODUCT_TYPE_KEYWORDS) + "))")
 
 
 def _normalize_product_type(name: str, category: str | None) -> str:
-    """Определяет тип изделия по названию и категории."""
-    combined = (name + " " + (category or "")).lower()
-    if "диффузор" in combined:
-        return "diffuser"
-    if "клапан" in combined:
-        return "valve"
-    if any(w in combined for w in ("решетка", "решётка")):
-        return "grille"
-    if "воздухораспределител" in combined:
-        return "distributor"
-    if "электропривод" in combined:
-        return "actuator"
-    if any(w in combined for w in ("фильтр", "hepa")):
-        return "filter"
-    if "корзин" in combined:
-        return "ac_basket"
-    if "шумоглушител" in combined:
-        return "silencer"
-    return "other"
-
-
-_SIZE_RE = re.compile(r"(\d+)\s*[×хxXХ]\s*(\d+)")
+    """Определяет тип изделия по названию и категории (один проход регуляркой по тексту)."""
+    best = None
+    for m in _PRODUCT_TYPE_RE.finditer((name + " " + (category or "")).lower()):
+        found = _PRODUCT_TYPE_RANK[m.group(1)]
+        if best is None or found < best:
+            best = found
+    return best[1] if best else "other"
+
+
+_SIZE_RE = re.compile(r"(\d+)\s*[×хx]\s*(\d+)", re.IGNORECASE)
 # Число (диаметр в мм): из значения вида «315», «200 мм», «Ø 400»
 _DIAMETER_NUM_RE = re.compile(r"\d{2,4}")
 
 
 def _normalize_size_group(name: str, raw_attrs: dict[str, str]) -> str:
     """Определяет размерную группу (small / large) по названию или характеристикам."""
-    search_text = name + " " + " ".join(raw_attrs.values())
-    m = _SIZE_RE.search(search_text)
-    if m:
-        max_side = max(int(m.group(1)), int(m.group(2)))
-        return "small" if max_side < 1000 else "large"
+    # Название и значения проверяются по очереди — без склейки в одну большую строку
+    for text in (name, *raw_attrs.values()):
+        m = _SIZE_RE.search(text)
+        if m:
+            max_side = max(int(m.group(1)), int(m.group(2)))
+            return "small" if max_side < 1000 else "large"
     return "unknown"
 
 
@@ -240,6 +333,7 @@ def _build_filters(raw_attrs: dict[str, str], name: str, category: str | None) -
     (Материал, Место применения, Регулируемая/Нерегулируемая) в строгие кодовые значения.
     """
     filters: dict[str, str] = {}
+    product_type = _normalize_product_type(name, category)
 
     mat_raw = raw_attrs.get("Материал", "")
     filters["material"] = _normalize_material(mat_raw) if mat_raw else "unknown"
@@ -258,7 +352,6 @@ def _build_filters(raw_attrs: dict[str, str], name: str, category: str | None) -
 
     # Форма решётки (для фильтра в сценариях «На фасад», «В воздуховод»)
     form_raw = raw_attrs.get("Форма", "").strip().lower()
-    all_text = (name + " " + " ".join(raw_attrs.values())).lower()
     if "прямоуголь" in form_raw:
         filters["form"] = "rectangular"
     elif "кругл" in form_raw:
@@ -269,11 +362,12 @@ def _build_filters(raw_attrs: dict[str, str], name: str, category: str | None) -
         filters["form"] = "cylindrical"
     elif form_raw:
         filters["form"] = form_raw[:50]  # иные значения как есть (нормализуем длину)
-    elif "кругл" in all_text and _normalize_product_type(name, category) == "grille":
-        # Круглые решётки: если в названии/атрибутах есть «кругл», а «Форма» на карточке пусто
+    elif product_type == "grille" and "кругл" in (name + " " + " ".join(raw_attrs.values())).lower():
+        # Круглые решётки: если в названии/атрибутах есть «кругл», а «Форма» на карточке пусто.
+        # Склейка и lower() всех атрибутов — только в этом редком случае, а не для каждого товара
         filters["form"] = "round"
 
-    filters["product_type"] = _normalize_product_type(name, category)
+    filters["product_type"] = product_type
     filters["size_group"] = _normalize_size_group(name, raw_attrs)
     # Круглые решётки: группа по диаметру (до 315 / до 500 / более 500 мм) для фильтра в сценарии
     if filters.get("form") == "round":
@@ -293,8 +387,26 @@ def _build_filters(raw_attrs: dict[str, str], name: str, category: str | None) -
 # ПАРСИНГ HTML
 # ═══════════════════════════════════════════════════════════════════════════════
 
-# Ссылка на товар: /catalog/{slug_категории}/{slug_товара}
-_PRODUCT_LINK_RE = re.compile(r"/catalog/[^/]+/[^/]+(?:\?|$|/)")
+# Ссылка на товар: [https://host]/catalog/{slug_категории}/{slug_товара}[/?#…] — проверяется одним match от начала
+_PRODUCT_LINK_RE = re.compile(r"(?:https?://[^/]+)?/catalog/[^/?#]+/[^/?#]+(?:[/?#]|$)")
+# Парсер страниц сайта: комментарии и processing instructions в дерево не попадают,
+# таблица id не строится — ни то ни другое разбору не нужно
+_HTML_PARSER = lxml.html.HTMLParser(remove_comments=True, remove_pis=True, collect_ids=False)
+# Ссылки и блок характеристик на странице категории.
+# Ссылки меню, подвала и фильтров без /catalog/ отсекаются ещё в XPath — до Python и _PRODUCT_LINK_RE
+_XP_LINKS = etree.XPath("//a[contains(@href, '/catalog/')]")
+_XP_ITEMS4_ATTRS = etree.XPath("(.//*[contains(@class, 'items4_attrs')])[1]")
+_XP_ATTR_ROWS = etree.XPath(".//div | .//li | .//tr")
+# Из строки нужны только два первых span (ключ и значение) — остальные не превращаем в Python-объекты
+_XP_KEY_VALUE_SPANS = etree.XPath("(.//span)[position() <= 2]")
+# Артикул и цена в тексте карточки каталога
+_CARD_ARTICLE_RE = re.compile(r"(?:Арт\.|код:)\s*(\d{3,})")
+_CARD_PRICE_RE = re.compile(r"(\d[\d\s]*\s*[₽Р]/шт|\d[\d\s]*\s*₽)")
+# Страница товара: подпись артикула, число артикула, артикул в конце URL, текст с ценой
+_ARTICLE_LABEL_RE = re.compile(r"(Артикул|Арт\.|код)")
+_ARTICLE_NUM_RE = re.compile(r"(\d{3,})")
+_URL_TAIL_ID_RE = re.compile(r"-(\d+)$")
+_PRICE_TEXT_RE = re.compile(r"\d[\d\s]*[₽Р]")
 
 
 def _parse_category_page(html: str, category_name: str) -> list[dict]:
@@ -302,30 +414,44 @@ def _parse_category_page(html: str, category_name: str) -> list[dict]:
     Из страницы категории собирает ссылки на карточки товаров (Deep Crawl).
     Каждая ссылка станет отправной точкой для парсинга страницы товара.
     """
-    soup = BeautifulSoup(html, "lxml")
+    tree = lxml.html.fromstring(html, parser=_HTML_PARSER)
     items: list[dict] = []
     seen_urls: set[str] = set()
+    # Текст карточки: в одной карточке несколько ссылок, text_content() обходит всё поддерево — считаем один раз.
+    # Ключ — сам элемент: словарь держит его Python-объект, и lxml возвращает тот же объект при повторном обходе
+    text_cache: dict[lxml.html.HtmlElement, str] = {}
+
+    def text_of(el: lxml.html.HtmlElement) -> str:
+        text = text_cache.get(el)
+        if text is None:
+            text = text_cache[el] = el.text_content()
+        return text
 
-    for a_tag in soup.find_all("a", href=True):
+    items_append = items.append
+    seen_add = seen_urls.add
+
+    for a_tag in _XP_LINKS(tree):
         href = (a_tag.get("href") or "").strip()
-        if not href or not _PRODUCT_LINK_RE.search(href):
+        if not _PRODUCT_LINK_RE.match(href):
             continue
         url = _abs_url(href)
         if url in seen_urls:
             continue
-        seen_urls.add(url)
+        seen_add(url)
 
-        path = href.split("?")[0].rstrip("/")
-        if path.count("/") < 3:
-            continue
+        # Карточка — ближайший div/article/li/section; один подъём по предкам на ссылку
+        card = next(a_tag.iterancestors("div", "article", "li", "section"), None)
 
-        name = _clean(a_tag.get_text())
+        name = _clean(a_tag.text_content())
         if not name or len(name) < 2:
             name = _clean(a_tag.get("title")) or ""
         if not name:
-            parent = a_tag.find_parent(["div", "article", "li"])
-            if parent:
-                name = _clean(parent.get_text())
+            # Для названия section не подходит — тогда берём ближайший div/article/li над ней
+            parent = card
+            if parent is not None and parent.tag == "section":
+                parent = next(parent.iterancestors("div", "article", "li"), None)
+            if parent is not None:
+                name = _clean(text_of(parent))
         if not name or len(name) < 2:
             name = "Товар"
 
@@ -333,24 +459,23 @@ def _parse_category_page(html: str, category_name: str) -> list[dict]:
         price: Optional[str] = None
         tags: list[str] = []
         card_attrs: dict[str, str] = {}
-        card = a_tag.find_parent(["div", "article", "li", "section"])
-        if card:
-            card_text = card.get_text()
-            art_m = re.search(r"(?:Арт\.|код:)\s*(\d{3,})", card_text)
+        if card is not None:
+            card_text = text_of(card)
+            art_m = _CARD_ARTICLE_RE.search(card_text)
             if art_m:
                 article = art_m.group(1)
-            price_m = re.search(r"(\d[\d\s]*\s*[₽Р]/шт|\d[\d\s]*\s*₽)", card_text)
+            price_m = _CARD_PRICE_RE.search(card_text)
             if price_m:
                 price = _clean(price_m.group(1))
             for label in ("Хит", "Акция", "Советуем", "Новинка"):
                 if label in card_text:
                     tags.append(label)
             # Характеристики только из блока items4_attrs на карточке каталога (все пары ключ-значение)
-            items4_block = card.select_one("[class*='items4_attrs']") or card.select_one(".items4_attrs")
-            if items4_block:
-                card_attrs = _parse_items4_attrs(items4_block)
+            items4_blocks = _XP_ITEMS4_ATTRS(card)
+            if items4_blocks:
+                card_attrs = _parse_items4_attrs(items4_blocks[0])
 
-        items.append({
+        items_append({
             "url": url,
             "name": name,
             "article": article,
@@ -365,25 +490,25 @@ def _parse_category_page(html: str, category_name: str) -> list[dict]:
 
 # ─── Парсинг блока характеристик ───────────────────────────────────────────────
 
-def _parse_items4_attrs(block: BeautifulSoup) -> dict[str, str]:
+def _parse_items4_attrs(block: lxml.html.HtmlElement) -> dict[str, str]:
     """
     Извлекает ВСЕ пары ключ-значение из блока items4_attrs (характеристики на карточке).
     На сайте ВРК ключ и значение в двух span, в двух div или в тексте «Ключ: Значение».
     Сценарий воронки синхронизирован с этими атрибутами (Материал, Место применения, Форма и т.д.).
     """
     attrs: dict[str, str] = {}
-    if not block:
+    if block is None:
         return attrs
     # Строки: div/li/tr с двумя span или текст «Ключ: Значение»
-    for row in block.select("div, li, tr"):
-        spans = row.select("span")
+    for row in _XP_ATTR_ROWS(block):
+        spans = _XP_KEY_VALUE_SPANS(row)
         if len(spans) >= 2:
-            k = _clean(spans[0].get_text()).rstrip(":—– \t")
-            v = _clean(spans[1].get_text())
+            k = _clean(spans[0].text_content()).rstrip(":—– \t")
+            v = _clean(spans[1].text_content())
             if k and v:
                 attrs[k] = v
         else:
-            text = _clean(row.get_text())
+            text = _clean(row.text_content())
             if ":" in text:
                 parts = text.split(":", 1)
                 k = parts[0].strip()
@@ -392,7 +517,7 @@ def _parse_items4_attrs(block: BeautifulSoup) -> dict[str, str]:
                     attrs[k] = v
     # Добираем по строкам текста блока («Ключ:» + следующая строка или «Ключ: Значение»)
     if not attrs:
-        lines = block.get_text().replace("\r", "\n").split("\n")
+        lines = block.text_content().replace("\r", "\n").split("\n")
         i = 0
         while i < len(lines):
             line = lines[i].strip()
@@ -416,7 +541,48 @@ def _parse_items4_attrs(block: BeautifulSoup) -> dict[str, str]:
 
 # ─── Парсинг описания товара ────────────────────────────────────────────────────
 
-def _parse_description(soup: BeautifulSoup) -> str | None:
+def _xp_div(*classes: str) -> str:
+    """XPath-условие «div со всеми указанными классами» (как CSS div.a.b)."""
+    conds = " and ".join(f"contains(concat(' ', normalize-space(@class), ' '), ' {c} ')" for c in classes)
+    return f"div[{conds}]"
+
+
+# Запросы к странице товара компилируются один раз (XPath в lxml выполняется на C)
+_XP_H1 = etree.XPath("(//h1)[1]")
+# Текстовые узлы-кандидаты отбираются в XPath (на C) по обязательной подстроке шаблона:
+# регулярка в Python проверяет только их, а не каждый узел документа
+_XP_ARTICLE_TEXTS = etree.XPath("//text()[contains(., 'Арт') or contains(., 'код')]")
+_XP_PRICE_TEXTS = etree.XPath("//text()[contains(., '₽') or contains(., 'Р')]")
+_XP_DESC_TAB = etree.XPath(f"(//{_xp_div('tab_content', 'active', 'ck-content')})[1]")
+_XP_BLOCK_TAB = etree.XPath(f"(.//{_xp_div('block_tab', 'text1')})[1]")
+_XP_P_LI = etree.XPath(".//p | .//li")
+_XP_P = etree.XPath(".//p")
+_XP_FALLBACK_CONTAINERS = tuple(
+    etree.XPath(f"(//{_xp_div(cls)})[1]") for cls in ("product-description", "product-text", "tab-content")
+)
+
+
+def _paragraphs(elements: list[lxml.html.HtmlElement]) -> list[str]:
+    """Тексты абзацев длиннее 20 символов."""
+    out = []
+    for el in elements:
+        txt = _clean(el.text_content())
+        if txt and len(txt) > 20:
+            out.append(txt)
+    return out
+
+
+def _first_text(
+    tree: lxml.html.HtmlElement, candidates: etree.XPath, pattern: re.Pattern[str],
+) -> etree._ElementUnicodeResult | None:
+    """Первый текстовый узел документа, в котором найден шаблон (как soup.find(string=...))."""
+    for text in candidates(tree):
+        if pattern.search(text):
+            return text
+    return None
+
+
+def _parse_description(tree: lxml.html.HtmlElement) -> str | None:
     """
     Извлекает текстовое описание товара из вкладки «Описание».
 
@@ -426,38 +592,26 @@ def _parse_description(soup: BeautifulSoup) -> str | None:
     3. Fallback через <p> внутри product-description / product-text
     """
     # Способ 1: вкладка «Описание» (активная)
-    tab = soup.select_one("div.tab_content.active.ck-content")
-    if tab:
-        block = tab.select_one("div.block_tab.text1")
-        target = block if block else tab
-        paragraphs = []
-        for el in target.find_all(["p", "li"]):
-            txt = _clean(el.get_text())
-            if txt and len(txt) > 20:
-                paragraphs.append(txt)
+    tabs = _XP_DESC_TAB(tree)
+    if tabs:
+        blocks = _XP_BLOCK_TAB(tabs[0])
+        target = blocks[0] if blocks else tabs[0]
+        paragraphs = _paragraphs(_XP_P_LI(target))
         if paragraphs:
             return "\n".join(paragraphs[:20])
 
     # Способ 2: первый block_tab.text1
-    block = soup.select_one("div.block_tab.text1")
-    if block:
-        paragraphs = []
-        for el in block.find_all(["p", "li"]):
-            txt = _clean(el.get_text())
-            if txt and len(txt) > 20:
-                paragraphs.append(txt)
+    blocks = _XP_BLOCK_TAB(tree)
+    if blocks:
+        paragraphs = _paragraphs(_XP_P_LI(blocks[0]))
         if paragraphs:
             return "\n".join(paragraphs[:20])
 
     # Способ 3: fallback
-    for cls in ("product-description", "product-text", "tab-content"):
-        container = soup.select_one(f"div.{cls}")
-        if container:
-            paragraphs = []
-            for p in container.find_all("p"):
-                txt = _clean(p.get_text())
-                if txt and len(txt) > 20:
-                    paragraphs.append(txt)
+    for xp in _XP_FALLBACK_CONTAINERS:
+        containers = xp(tree)
+        if containers:
+            paragraphs = _paragraphs(_XP_P(containers[0]))
             if paragraphs:
                 return "\n".join(paragraphs[:15])
 
@@ -471,28 +625,46 @@ def _parse_product_page(html: str, base_info: dict) -> Product:
     Со страницы товара берём только: описание (div.block_tab.text1), ссылку и цену.
     Характеристики — только из карточек каталога (items4_attrs), со страницы не парсим.
     """
-    soup = BeautifulSoup(html, "lxml")
+    tree = lxml.html.fromstring(html, parser=_HTML_PARSER)
 
     # Название (H1)
-    h1 = soup.find("h1")
-    name = _clean(h1.get_text()) if h1 else base_info.get("name", "")
+    h1 = _XP_H1(tree)
+    name = _clean(h1[0].text_content()) if h1 else base_info.get("name", "")
 
     # Артикул (из карточки или со страницы)
     article = base_info.get("article", "")
     if not article:
-        art_el = soup.find(string=re.compile(r"(Артикул|Арт\.|код)"))
-        if art_el:
-            m = re.search(r"(\d{3,})", str(art_el.parent.get_text() if art_el.parent else art_el))
+        art_el = _first_text(tree, _XP_ARTICLE_TEXTS, _ARTICLE_LABEL_RE)
+        if art_el is not None:
+            # Хвост (tail) принадлежит соседнему элементу — текст берём у его родителя
+            parent = art_el.getparent()
+            if parent is not None and art_el.is_tail:
+                parent = parent.getparent()
+            m = _ARTICLE_NUM_RE.search(parent.text_content() if parent is not None else str(art_el))
             if m:
                 article = m.group(1)
     if not article:
-        m = re.search(r"-(\d+)$", base_info.get("url", ""))
+        m = _URL_TAIL_ID_RE.search(base_info.get("url", ""))
         if m:
             article = m.group(1)
 
     # Описание — только из div.block_tab.text1
-    description = _parse_description(soup)
+    description = _parse_description(tree)
+
+    # Цена — с карточки или со страницы
+    page_price = None
+    if not base_info.get("price"):
+        price_el = _first_text(tree, _XP_PRICE_TEXTS, _PRICE_TEXT_RE)
+        if price_el is not None:
+            page_price = _clean(str(price_el))
 
+    return _build_product(base_info, name, article, description, page_price)
+
+
+def _build_product(
+    base_info: dict, name: str, article: str, description: str | None, page_price: str | None,
+) -> Product:
+    """Товар из данных карточки каталога и полей, взятых со страницы товара."""
     # Характеристики только с карточки каталога (items4_attrs), со страницы не берём
     raw_attrs = base_info.get("card_attrs") or {}
 
@@ -503,17 +675,12 @@ def _parse_product_page(html: str, base_info: dict) -> Product:
     # Ссылка — из карточки
     url = base_info["url"]
 
-    # Цена — с карточки или со страницы
-    price = base_info.get("price")
-    if not price:
-        price_el = soup.find(string=re.compile(r"\d[\d\s]*[₽Р]"))
-        if price_el:
-            price = _clean(str(price_el))
+    price = base_info.get("price") or page_price
 
     old_price: Optional[str] = None
 
     product = Product(
-        article=article or hashlib.md5(url.encode()).hexdigest()[:8],
+        article=article or hashlib.blake2b(url.encode(), digest_size=4).hexdigest(),
         name=name,
         url=url,
         price=price,
@@ -521,6 +688,7 @@ def _parse_product_page(html: str, base_info: dict) -> Product:
         description=description,
         category=category,
         raw_attrs=raw_attrs,
+        raw_attrs_json=orjson.dumps(raw_attrs).decode(),
         filters=filters,
         tags=base_info.get("tags", []),
     )
@@ -530,53 +698,85 @@ def _parse_product_page(html: str, base_info: dict) -> Product:
 
 # ─── Основной процесс парсинга ────────────────────────────────────────────────
 
-async def scrape_all() -> list[Product]:
+async def scrape_all(existing: dict[str, Product] | None = None) -> list[Product]:
     """
     Полный цикл Deep Crawl:
     1. Обходит все категории из START_URLS (данные парсятся и сохраняются по категориям).
     2. Собирает ссылки на карточки товаров.
     3. Загружает каждую карточку и извлекает данные + характеристики + фильтры.
     У каждого товара сохраняется поле category (slug страницы каталога).
+    Страницы загружаются параллельно, не более SCRAPER_CONCURRENCY запросов одновременно.
+    existing — ранее сохранённые товары: их страницы запрашиваются условно (ETag / Last-Modified),
+    и при ответе 304 страница не загружается и не парсится повторно.
     """
-    all_products: dict[str, Product] = {}
-
-    async with httpx.AsyncClient() as client:
-        for cat_url in START_URLS:
-            cat_name = cat_url.rstrip("/").split("/")[-1]
-            log.info("Парсинг категории: %s", cat_name)
+    existing = existing or {}
+    _clean_short.cache_clear()
+    sem = asyncio.Semaphore(SCRAPER_CONCURRENCY)
 
+    async def fetch_category(cat_url: str) -> list[dict]:
+        cat_name = cat_url.rstrip("/").split("/")[-1]
+        async with sem:
             try:
-                cat_html = await _fetch(client, cat_url)
+                cat_html = (await _fetch(cat_url)).text
             except Exception as exc:
                 log.error("Ошибка загрузки категории %s: %s", cat_url, exc)
-                continue
-
-            card_infos = _parse_category_page(cat_html, cat_name)
-            log.info("  Найдено карточек: %d", len(card_infos))
-
-            for info in card_infos:
-                url = info["url"]
-                if url in all_products:
-                    # Товар уже добавлен с другой страницы каталога — обновляем категорию на текущую,
-                    # чтобы раздел каталога (щелевые, диффузоры и т.д.) определялся последним вхождением
-                    all_products[url].category = cat_name
-                    continue
-
-                await asyncio.sleep(random.uniform(0.5, SCRAPER_REQUEST_DELAY))
-
-                try:
-                    prod_html = await _fetch(client, url)
-                    product = _parse_product_page(prod_html, info)
-                    all_products[product.url] = product
-                    log.debug(
-                        "  ✓ %s (арт. %s) | фильтры: %s | attrs: %d шт.",
-                        product.name,
-                        product.article,
-                        product.filters,
-                        len(product.raw_attrs),
-                    )
-                except Exception as exc:
-                    log.error("  Ошибка парсинга %s: %s", url, exc)
+                return []
+        card_infos = _parse_category_page(cat_html, cat_name)
+        log.info("Категория %s: найдено карточек: %d", cat_name, len(card_infos))
+        return card_infos
+
+    async def fetch_product(info: dict) -> Product | None:
+        url = info["url"]
+        prev = existing.get(url)
+        async with sem:
+            await asyncio.sleep(random.uniform(0.5, SCRAPER_REQUEST_DELAY))
+            try:
+                resp = await _fetch(url, _conditional_headers(prev))
+            except Exception as exc:
+                log.error("  Ошибка загрузки %s: %s", url, exc)
+                return None
+        try:
+            if resp.status_code == 304 and prev is not None:
+                # Страница не менялась: берём её поля из прошлого обхода, карточку каталога — свежую
+                product = _build_product(
+                    info, prev.name, info.get("article") or prev.article, prev.description, prev.price,
+                )
+                product.etag, product.last_modified = prev.etag, prev.last_modified
+            else:
+                # Разбор HTML — в потоке: lxml отпускает GIL, event loop тем временем качает страницы
+                product = await asyncio.to_thread(_parse_product_page, resp.text, info)
+                product.etag = resp.headers.get("etag")
+                product.last_modified = resp.headers.get("last-modified")
+        except Exception as exc:
+            log.error("  Ошибка парсинга %s: %s", url, exc)
+            return None
+        log.debug(
+            "  ✓ %s (арт. %s) | фильтры: %s | attrs: %d шт.",
+            product.name,
+            product.article,
+            product.filters,
+            len(product.raw_attrs),
+        )
+        return product
+
+    per_category = await asyncio.gather(*(fetch_category(u) for u in START_URLS))
+
+    # Товар парсится по первой карточке, а раздел каталога (щелевые, диффузоры и т.д.)
+    # определяется последним вхождением — как при последовательном обходе категорий
+    first_info: dict[str, dict] = {}
+    last_category: dict[str, str] = {}
+    for card_infos in per_category:
+        for info in card_infos:
+            first_info.setdefault(info["url"], info)
+            last_category[info["url"]] = info["category"]
+
+    fetched = await asyncio.gather(*(fetch_product(info) for info in first_info.values()))
+
+    all_products: dict[str, Product] = {}
+    for product in fetched:
+        if product is not None:
+            product.category = last_category[product.url]
+            all_products[product.url] = product
 
     result = list(all_products.values())
     log.info("Всего собрано товаров: %d", len(result))
@@ -585,20 +785,35 @@ async def scrape_all() -> list[Product]:
 
 # ─── Delta Update ──────────────────────────────────────────────────────────────
 
+def _product_from_dict(p: dict) -> Product:
+    """Товар из сохранённой записи (с миграцией старого формата)."""
+    if "characteristics" in p and "raw_attrs" not in p:
+        p["raw_attrs"] = p.pop("characteristics")
+    if "filters" not in p:
+        p["filters"] = {}
+    p.pop("characteristics", None)
+    # Файл записан самим парсером из провалидированных моделей — повторная проверка не нужна
+    return Product(**p) if SCRAPER_VALIDATE_ON_LOAD else Product.model_construct(**p)
+
+
 def _load_existing() -> dict[str, Product]:
-    """Загружает ранее сохранённые товары из JSON (с миграцией старого формата)."""
+    """
+    Загружает ранее сохранённые товары: NDJSON (один товар на строку) читается построчно,
+    файл старого формата (один JSON-массив) — целиком.
+    """
     if not RAW_PRODUCTS_PATH.exists():
         return {}
     try:
-        data = json.loads(RAW_PRODUCTS_PATH.read_text(encoding="utf-8"))
         products: dict[str, Product] = {}
-        for p in data:
-            if "characteristics" in p and "raw_attrs" not in p:
-                p["raw_attrs"] = p.pop("characteristics")
-            if "filters" not in p:
-                p["filters"] = {}
-            p.pop("characteristics", None)
-            products[p["url"]] = Product(**p)
+        with RAW_PRODUCTS_PATH.open("rb") as f:
+            if f.read(1) == b"[":
+                f.seek(0)
+                records = orjson.loads(f.read())
+            else:
+                f.seek(0)
+                records = (orjson.loads(line) for line in f if line.strip())
+            for p in records:
+                products[p["url"]] = _product_from_dict(p)
         return products
     except Exception as exc:
         log.warning("Не удалось загрузить %s: %s", RAW_PRODUCTS_PATH, exc)
@@ -606,13 +821,18 @@ def _load_existing() -> dict[str, Product]:
 
 
 def _save_products(products: dict[str, Product]) -> None:
-    """Сохраняет товары в JSON."""
-    data = [p.model_dump() for p in products.values()]
-    RAW_PRODUCTS_PATH.write_text(
-        json.dumps(data, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
-    log.info("Сохранено %d товаров в %s", len(data), RAW_PRODUCTS_PATH)
+    """
+    Сохраняет товары в NDJSON: по одному товару на строку (orjson), без сборки всего файла в памяти.
+    Пишется во временный файл и подменяет старый целиком — читатель не увидит недописанный каталог.
+    """
+    RAW_PRODUCTS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = RAW_PRODUCTS_PATH.with_suffix(RAW_PRODUCTS_PATH.suffix + ".tmp")
+    with tmp_path.open("wb") as f:
+        for p in products.values():
+            f.write(orjson.dumps(p.model_dump()))
+            f.write(b"\n")
+    tmp_path.replace(RAW_PRODUCTS_PATH)
+    log.info("Сохранено %d товаров в %s", len(products), RAW_PRODUCTS_PATH)
 
 
 async def run_delta_update() -> dict[str, list[str]]:
@@ -622,7 +842,7 @@ async def run_delta_update() -> dict[str, list[str]]:
     Возвращает отчёт: {"added": [...], "updated": [...], "removed": [...], "unchanged": [...]}.
     """
     existing = _load_existing()
-    fresh = await scrape_all()
+    fresh = await scrape_all(existing)
 
     fresh_by_url = {p.url: p for p in fresh}
 
@@ -634,9 +854,26 @@ async def run_delta_update() -> dict[str, list[str]]:
     }
 
     for url, product in fresh_by_url.items():
-        if url not in existing:
+        old = existing.get(url)
+        if old is not None:
+            _adopt_legacy_article(product, old)
+
+    fresh_articles = {p.article for p in fresh}
+    for url, product in fresh_by_url.items():
+        old = existing.get(url)
+        if old is None:
+            report["added"].append(product.article)
+        elif old.article != product.article:
+            # Артикул — ID документа в ChromaDB: старый документ удаляем, новый добавляем
             report["added"].append(product.article)
-        elif existing[url].content_hash != product.content_hash:
+            if old.article not in fresh_articles:
+                report["removed"].append(old.article)
+        elif (
+            old.content_hash != product.content_hash
+            # Хеш, записанный до перехода на blake2b: сверяем по старой формуле один раз,
+            # дальше в файле остаётся новый хеш
+            and old.content_hash != _legacy_content_hash(product)
+        ):
             report["updated"].append(product.article)
         else:
             report["unchanged"].append(product.article)
@@ -682,11 +919,15 @@ def _scenario_block_from_filters(filters: dict[str, str], main_cat: str) -> str:
     return f"{pt}_{loc}_{sg}"
 
 
-def process_to_chunks(products: list[Product] | None = None) -> list[dict]:
+def process_to_chunks(
+    products: list[Product] | None = None,
+    only_articles: set[str] | None = None,
+) -> list[dict]:
     """
     Превращает список товаров в текстовые чанки для ChromaDB.
     Чанки сортируются по пути сценария (product_type → location → size_group → form),
     чтобы при поиске по сценарию LLM шла в нужный блок базы.
+    only_articles — строить чанки только для этих артикулов (остальные товары пропускаются).
     """
     if products is None:
         existing = _load_existing()
@@ -694,28 +935,28 @@ def process_to_chunks(products: list[Product] | None = None) -> list[dict]:
 
     chunks: list[dict] = []
     seen_articles: set[str] = set()
+    # Локальные ссылки на методы — без поиска атрибута на каждой итерации
+    chunks_append = chunks.append
+    seen_add = seen_articles.add
 
     for p in products:
         if p.article in seen_articles:
             continue
-        seen_articles.add(p.article)
+        if only_articles is not None and p.article not in only_articles:
+            continue
+        seen_add(p.article)
 
         # Текст чанка для семантического поиска
-        attrs_text = "; ".join(f"{k}: {v}" for k, v in p.raw_attrs.items())
-
-        text_parts = [
-            f"Название: {p.name}",
-            f"Артикул: {p.article}",
-        ]
-        if p.category:
-            text_parts.append(f"Категория: {p.category}")
-        if p.price:
-            text_parts.append(f"Цена: {p.price}")
-        if attrs_text:
-            text_parts.append(f"Характеристики: {attrs_text}")
-        if p.description:
-            text_parts.append(f"Описание: {p.description[:3000]}")
-        text_parts.append(f"Ссылка: {p.url}")
+        attrs_text = "; ".join(f"{k}: {v}" for k, v in p.raw_attrs.items()) if p.raw_attrs else ""
+
+        text = (
+            f"Название: {p.name}\nАртикул: {p.article}\n"
+            + (f"Категория: {p.category}\n" if p.category else "")
+            + (f"Цена: {p.price}\n" if p.price else "")
+            + (f"Характеристики: {attrs_text}\n" if attrs_text else "")
+            + (f"Описание: {p.description[:3000]}\n" if p.description else "")
+            + f"Ссылка: {p.url}"
+        )
 
         sub_cat = p.category or ""
         main_cat = CATEGORY_SLUG_MAP.get(sub_cat, "")
@@ -732,11 +973,12 @@ def process_to_chunks(products: list[Product] | None = None) -> list[dict]:
         if main_cat and main_cat in MAIN_CATEGORIES:
             metadata["product_type"] = main_cat
         metadata["scenario_block"] = _scenario_block_from_filters(metadata, main_cat)
-        metadata["raw_attrs_json"] = json.dumps(p.raw_attrs, ensure_ascii=False)
+        # У товаров, сохранённых до появления поля, строки нет — сериализуем на месте
+        metadata["raw_attrs_json"] = p.raw_attrs_json or orjson.dumps(p.raw_attrs).decode()
 
-        chunks.append({
+        chunks_append({
             "id": p.article,
-            "text": "\n".join(text_parts),
+            "text": text,
             "metadata": metadata,
         })
 
@@ -0,0 +1,87 @@
+"""
+Семантический кеш ответов на свободные вопросы.
+
+Если новый вопрос по смыслу совпадает с недавно отвеченным (косинусное сходство
+нормированных эмбеддингов не ниже порога), возвращается сохранённый ответ —
+без поиска в ChromaDB и без запроса к LLM.
+Методы потокобезопасны: поиск по кешу выполняется в пуле потоков вместе с эмбеддингом.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Не более maxsize ответов, каждый живёт ttl секунд; при переполнении
+    вытесняется ответ, к которому дольше всего не обращались.
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: float = 3600, threshold: float = 0.92) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._matrix: np.ndarray | None = None   # строки — нормированные эмбеддинги вопросов
+        self._payloads: list[Any] = []
+        self._expires_at: list[float] = []
+        self._last_used: list[float] = []
+        self._lock = threading.Lock()
+
+    def lookup(self, embedding: np.ndarray) -> Any | None:
+        """Сохранённый ответ на ближайший похожий вопрос или None."""
+        with self._lock:
+            if self._matrix is None:
+                return None
+            scores = self._matrix @ embedding
+            i = int(np.argmax(scores))
+            if scores[i] < self.threshold:
+                return None
+            now = time.monotonic()
+            if self._expires_at[i] <= now:
+                self._remove([i])
+                return None
+            self._last_used[i] = now
+            return self._payloads[i]
+
+    def put(self, embedding: np.ndarray, payload: Any) -> None:
+        with self._lock:
+            now = time.monotonic()
+            expired = [i for i, t in enumerate(self._expires_at) if t <= now]
+            if expired:
+                self._remove(expired)
+            if len(self._payloads) >= self.maxsize:
+                self._remove([int(np.argmin(self._last_used))])
+            row = embedding.reshape(1, -1)
+            self._matrix = row if self._matrix is None else np.vstack((self._matrix, row))
+            self._payloads.append(payload)
+            self._expires_at.append(now + self.ttl)
+            self._last_used.append(now)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def _clear(self) -> None:
+        self._matrix = None
+        self._payloads.clear()
+        self._expires_at.clear()
+        self._last_used.clear()
+
+    def _remove(self, indices: list[int]) -> None:
+        drop = set(indices)
+        keep = [i for i in range(len(self._payloads)) if i not in drop]
+        if not keep:
+            self._clear()
+            return
+        self._matrix = self._matrix[keep]
+        self._payloads = [self._payloads[i] for i in keep]
+        self._expires_at = [self._expires_at[i] for i in keep]
+        self._last_used = [self._last_used[i] for i in keep]
+
+    def __len__(self) -> int:
+        return len(self._payloads)
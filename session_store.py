@@ -0,0 +1,112 @@
+"""
+Состояние сессии диалога и его внешнее хранилище (Redis).
+
+Без REDIS_URL сессии живут только в памяти процесса main.py, как и раньше.
+С REDIS_URL состояние сессии загружается перед обработкой сообщения и
+сохраняется после неё (orjson, TTL), поэтому бэкенд можно запускать
+в несколько воркеров uvicorn.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass, field, fields
+from typing import Any, Optional
+
+import orjson
+
+from config import REDIS_URL, SESSION_HISTORY_LENGTH, SESSION_TTL_SECONDS
+from logger import get_logger
+
+log = get_logger(__name__)
+
+
+# ─── Состояние сессии ─────────────────────────────────────────────────────────
+
+@dataclass(slots=True)
+class Session:
+    """Состояние диалога одного пользователя (воронка подбора + история)."""
+
+    funnel_phase: Optional[str] = None      # None | "product_type" | "scenario" | "detail"
+    scenario_key: Optional[str] = None
+    step_idx: int = 0
+    active_filters: dict[str, str] = field(default_factory=dict)
+    # сообщения {"role": "user" | "assistant", "content": ...}; старые вытесняются при append
+    history: deque = field(default_factory=lambda: deque(maxlen=SESSION_HISTORY_LENGTH))
+    # Smart Routing (grille)
+    grille_phase: Optional[str] = None      # None | "mount" | "feature" | "done"
+    allowed_subcats: list[str] = field(default_factory=list)   # допустимые slug подкатегорий
+    grille_routing: list[dict] = field(default_factory=list)   # стек решений [{step, value, subcats_before}]
+    # Detail branch (CSV decision tree)
+    detail_branch: Optional[str] = None     # "facade" | "indoor" | "slot" | None
+    detail_step_idx: int = 0
+    detail_answers: dict[str, str] = field(default_factory=dict)   # ответы на шаги детальной ветки
+    detected_intents: dict[str, bool] = field(default_factory=dict)  # analog, custom, mechanical_vent, budget, premium
+
+
+_FIELDS = tuple(f.name for f in fields(Session))
+
+
+# ─── Redis ────────────────────────────────────────────────────────────────────
+
+_KEY_PREFIX = "vrk:session:"
+
+_redis: Optional[Any] = None
+
+
+def redis_enabled() -> bool:
+    return bool(REDIS_URL)
+
+
+def get_redis() -> Any:
+    """Возвращает клиент redis.asyncio (один на процесс)."""
+    global _redis
+    if _redis is None:
+        import redis.asyncio as redis
+
+        _redis = redis.Redis.from_url(REDIS_URL)
+        log.info("Сессии: хранилище Redis %s", REDIS_URL.rsplit("@", 1)[-1])
+    return _redis
+
+
+async def close_redis() -> None:
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+
+
+# ─── Сериализация ─────────────────────────────────────────────────────────────
+
+def _dumps(session: Session) -> bytes:
+    data = {name: getattr(session, name) for name in _FIELDS}
+    data["history"] = list(session.history)
+    return orjson.dumps(data)
+
+
+def _loads(raw: bytes) -> Session:
+    data = orjson.loads(raw)
+    # Неизвестные ключи (старый формат) отбрасываются, недостающие берутся по умолчанию
+    session = Session(**{k: v for k, v in data.items() if k in _FIELDS and k != "history"})
+    session.history.extend(data.get("history", []))
+    return session
+
+
+# ─── Загрузка / сохранение ────────────────────────────────────────────────────
+
+async def load_session(session_id: str) -> Session | None:
+    """Сессия из Redis или None (не найдена, истёк TTL или Redis недоступен)."""
+    try:
+        raw = await get_redis().get(_KEY_PREFIX + session_id)
+    except Exception as exc:
+        log.warning("Redis: не удалось загрузить сессию %s: %s", session_id[:8], exc)
+        return None
+    return _loads(raw) if raw else None
+
+
+async def save_session(session_id: str, session: Session) -> None:
+    """Сохраняет сессию в Redis с TTL (продлевается при каждом сообщении)."""
+    try:
+        await get_redis().set(_KEY_PREFIX + session_id, _dumps(session), ex=SESSION_TTL_SECONDS)
+    except Exception as exc:
+        log.warning("Redis: не удалось сохранить сессию %s: %s", session_id[:8], exc)
@@ -15,8 +15,12 @@ Telegram-бот ООО "Завод ВРК" на aiogram 3.x.
 from __future__ import annotations
 
 import asyncio
+import functools
 import re
+from html import escape
 import uuid
+import weakref
+from typing import Any, Awaitable, Callable
 
 
 async def _ensure_response(raw):
@@ -37,18 +41,22 @@ from aiogram.types import (
 
 from config import (
     PRODUCT_TYPE_STEP,
+    SESSION_MAX,
+    SESSION_TTL_SECONDS,
     TELEGRAM_BOT_TOKEN,
     TELEGRAM_WELCOME_TEXT,
 )
 from logger import get_logger
 from main import process_message
 from models import ButtonOption, ChatAction, ChatRequest, ChatResponse
+from ttl_cache import TTLCache
 
 log = get_logger(__name__)
 
 router = Router()
 
-_user_sessions: dict[int, str] = {}
+# user_id → session_id; забывается после SESSION_TTL_SECONDS простоя (сессия в main.py к тому времени уже истекла)
+_user_sessions = TTLCache(maxsize=SESSION_MAX, ttl=SESSION_TTL_SECONDS, sliding=True)
 
 _NAV_ROW = [
     InlineKeyboardButton(text="◀️ Назад", callback_data="__back__"),
@@ -57,9 +65,11 @@ _NAV_ROW = [
 
 
 def _session_id(user_id: int) -> str:
-    if user_id not in _user_sessions:
-        _user_sessions[user_id] = f"tg_{user_id}_{uuid.uuid4().hex[:8]}"
-    return _user_sessions[user_id]
+    session_id = _user_sessions.get(user_id)
+    if session_id is None:
+        session_id = f"tg_{user_id}_{uuid.uuid4().hex[:8]}"
+        _user_sessions.set(user_id, session_id)
+    return session_id
 
 
 def _reset_session(user_id: int) -> None:
@@ -71,9 +81,12 @@ def _reset_session(user_id: int) -> None:
 
 # ─── Утилиты ──────────────────────────────────────────────────────────────────
 
+_MAIN_MENU_QUESTION: str = PRODUCT_TYPE_STEP["question"]
+
+
 def _is_main_menu(response: ChatResponse) -> bool:
     """Проверяет, является ли ответ главным меню (выбор категории)."""
-    return response.reply == PRODUCT_TYPE_STEP["question"]
+    return response.reply == _MAIN_MENU_QUESTION
 
 
 def _build_inline_keyboard(
@@ -82,13 +95,21 @@ def _build_inline_keyboard(
     product_url: str | None = None,
 ) -> InlineKeyboardMarkup:
     """Собирает Inline-клавиатуру: кнопки воронки + ссылка на товар + навигация."""
-    rows: list[list[InlineKeyboardButton]] = []
-    if buttons:
-        for btn in buttons:
-            cb_data = (btn.value or btn.label)[:64]
-            rows.append([
-                InlineKeyboardButton(text=btn.label, callback_data=cb_data)
-            ])
+    key = tuple((btn.label, (btn.value or btn.label)[:64]) for btn in buttons) if buttons else ()
+    return _cached_keyboard(key, with_nav, product_url)
+
+
+@functools.lru_cache(maxsize=512)
+def _cached_keyboard(
+    buttons: tuple[tuple[str, str], ...],
+    with_nav: bool,
+    product_url: str | None,
+) -> InlineKeyboardMarkup:
+    """
+    Клавиатура по (текст, callback_data) кнопок. Набор кнопок шага воронки повторяется
+    от ответа к ответу — модель aiogram собирается один раз и переиспользуется (при отправке не меняется).
+    """
+    rows = [[InlineKeyboardButton(text=label, callback_data=cb_data)] for label, cb_data in buttons]
     if product_url:
         rows.append([InlineKeyboardButton(text="🔗 Открыть на сайте", url=product_url)])
     if with_nav:
@@ -97,17 +118,17 @@ def _build_inline_keyboard(
 
 
 def _format_product_card(data: dict) -> str:
-    """Форматирует карточку товара для Telegram (без голых URL)."""
+    """Форматирует карточку товара для Telegram (без голых URL, поля экранированы для HTML)."""
+    get = data.get
     parts = []
-    if data.get("name"):
-        parts.append(f"<b>{data['name']}</b>")
-    if data.get("article"):
-        parts.append(f"Артикул: {data['article']}")
-    if data.get("price"):
-        parts.append(f"💰 Цена: <b>{data['price']}</b>")
-    if data.get("location"):
-        loc_label = "наружное" if data["location"] == "outdoor" else "внутреннее"
-        parts.append(f"Назначение: {loc_label}")
+    if name := get("name"):
+        parts.append(f"<b>{escape(name, quote=False)}</b>")
+    if article := get("article"):
+        parts.append(f"Артикул: {escape(article, quote=False)}")
+    if price := get("price"):
+        parts.append(f"💰 Цена: <b>{escape(price, quote=False)}</b>")
+    if location := get("location"):
+        parts.append(f"Назначение: {'наружное' if location == 'outdoor' else 'внутреннее'}")
     return "\n".join(parts)
 
 
@@ -119,6 +140,38 @@ def _strip_bare_urls(text: str) -> str:
     return _URL_RE.sub("", text).strip()
 
 
+def _reply_text(reply: str) -> str:
+    """Текст ответа для parse_mode=HTML: без голых URL, «<», «>» и «&» экранированы (разметки в ответах нет)."""
+    return escape(_strip_bare_urls(reply), quote=False)
+
+
+# ─── Частота отправки ─────────────────────────────────────────────────────────
+
+# Telegram отвечает 429 примерно после 30 сообщений в секунду от бота — держим запас
+_SEND_INTERVAL = 1 / 25
+_next_send_at = 0.0
+# chat_id → asyncio.Lock: ответы одному чату не перемежаются (список товаров — несколько сообщений подряд).
+# Слабые ссылки: замок живёт, пока его держат или ждут, и сам уходит из словаря, когда чат затих
+_chat_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+
+async def _throttle() -> None:
+    """Ждёт очереди на отправку: сообщения всех чатов идут не чаще одного в _SEND_INTERVAL."""
+    global _next_send_at
+    now = asyncio.get_running_loop().time()
+    send_at = max(now, _next_send_at)
+    _next_send_at = send_at + _SEND_INTERVAL
+    if send_at > now:
+        await asyncio.sleep(send_at - now)
+
+
+def _chat_lock(chat_id: int) -> asyncio.Lock:
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+
 async def _send_response(
     target: Message | CallbackQuery,
     response: ChatResponse,
@@ -130,39 +183,44 @@ async def _send_response(
       сообщением с кнопкой «Открыть на сайте», в конце «Надеюсь я вам помог!» с Назад/Главное меню.
     - Иначе: одно сообщение, при одном товаре — кнопка «Открыть на сайте», навигация.
     """
-    if isinstance(target, CallbackQuery):
-        send = target.message.answer
-    else:
-        send = target.answer
+    message = target.message if isinstance(target, CallbackQuery) else target
+
+    async def send(text: str, **kwargs: Any) -> None:
+        await _throttle()
+        await message.answer(text, **kwargs)
+
+    async with _chat_lock(message.chat.id):
+        await _deliver(send, response)
+
 
+async def _deliver(send: Callable[..., Awaitable[None]], response: ChatResponse) -> None:
+    """Формирует и отправляет сообщения ответа (см. _send_response)."""
     # Выдача списка товаров: каждое сообщение отдельно
     if response.products and len(response.products) > 0:
         await send(
-            _strip_bare_urls(response.reply),
+            _reply_text(response.reply),
             parse_mode=ParseMode.HTML,
         )
         for product in response.products:
             card_text = _format_product_card(product)
             url = product.get("url")
             if url:
-                kb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔗 Открыть на сайте", url=url)]
-                ])
+                kb = _build_inline_keyboard(with_nav=False, product_url=url)
                 await send(card_text, parse_mode=ParseMode.HTML, reply_markup=kb)
             else:
                 await send(card_text, parse_mode=ParseMode.HTML)
         await send(
             "Надеюсь я вам помог!",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[_NAV_ROW]),
+            reply_markup=_build_inline_keyboard(),
         )
         return
 
     # Обычное сообщение (один товар или без товара)
-    text = _strip_bare_urls(response.reply)
+    text = _reply_text(response.reply)
     product_url = None
     if response.action == ChatAction.SHOW_PRODUCT and response.product_data:
         card = _format_product_card(response.product_data)
-        text = f"{_strip_bare_urls(text)}\n\n{card}"
+        text = f"{text}\n\n{card}"
         product_url = response.product_data.get("url")
 
     show_nav = not _is_main_menu(response)
@@ -2,38 +2,62 @@
 Управление векторной базой ChromaDB.
 
 Отвечает за:
-- Инициализацию / подключение к persistent-хранилищу.
+- Инициализацию / подключение к persistent-хранилищу или серверу ChromaDB (CHROMA_HOST).
 - Индексацию чанков (upsert — добавление/обновление, удаление).
 - Семантический поиск с фильтрацией по метаданным.
 """
 
 from __future__ import annotations
 
+import asyncio
+import json
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path
 from typing import Optional
 
 import chromadb
+import numpy as np
 from chromadb.config import Settings as ChromaSettings
-
-from config import CHROMA_COLLECTION_NAME, CHROMA_PERSIST_DIR
+from chromadb.utils import embedding_functions
+
+from config import (
+    CHROMA_COLLECTION_NAME,
+    CHROMA_HOST,
+    CHROMA_PERSIST_DIR,
+    CHROMA_PORT,
+    CHROMA_UPSERT_BATCH_SIZE,
+)
 from logger import get_logger
 from scraper import process_to_chunks
+from ttl_cache import TTLCache
 
 log = get_logger(__name__)
 
 _client: Optional[chromadb.ClientAPI] = None
 _collection: Optional[chromadb.Collection] = None
+_embedding_fn: Optional[embedding_functions.DefaultEmbeddingFunction] = None
 
 
 def reset_db() -> None:
     """
-    Удаляет директорию ChromaDB и сбрасывает кэш подключения.
+    Удаляет директорию ChromaDB (на сервере ChromaDB — коллекцию) и сбрасывает кэш подключения.
     После вызова следующий get_collection() создаст новую БД.
     Вызывайте при остановленном приложении, чтобы не держать открытые файлы.
     """
     global _client, _collection
     _collection = None
+    _invalidate_caches()
+    if CHROMA_HOST:
+        try:
+            _get_client().delete_collection(CHROMA_COLLECTION_NAME)
+            log.info("ChromaDB: коллекция '%s' удалена на сервере %s", CHROMA_COLLECTION_NAME, CHROMA_HOST)
+        except Exception as exc:
+            log.info("ChromaDB: коллекция '%s' не удалена — %s", CHROMA_COLLECTION_NAME, exc)
+        return
     _client = None
     path = Path(CHROMA_PERSIST_DIR)
     if path.exists():
@@ -46,14 +70,24 @@ def reset_db() -> None:
 def _get_client() -> chromadb.ClientAPI:
     global _client
     if _client is None:
-        _client = chromadb.PersistentClient(
-            path=CHROMA_PERSIST_DIR,
-            settings=ChromaSettings(anonymized_telemetry=False),
-        )
-        log.info("ChromaDB: подключение к %s", CHROMA_PERSIST_DIR)
+        settings = ChromaSettings(anonymized_telemetry=False)
+        if CHROMA_HOST:
+            _client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT, settings=settings)
+            log.info("ChromaDB: подключение к серверу %s:%d", CHROMA_HOST, CHROMA_PORT)
+        else:
+            _client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR, settings=settings)
+            log.info("ChromaDB: подключение к %s", CHROMA_PERSIST_DIR)
     return _client
 
 
+def _get_embedding_function() -> embedding_functions.DefaultEmbeddingFunction:
+    """Модель эмбеддингов коллекции (ChromaDB по умолчанию) — одна на процесс."""
+    global _embedding_fn
+    if _embedding_fn is None:
+        _embedding_fn = embedding_functions.DefaultEmbeddingFunction()
+    return _embedding_fn
+
+
 def get_collection() -> chromadb.Collection:
     """Возвращает (или создаёт) коллекцию товаров."""
     global _collection
@@ -62,51 +96,138 @@ def get_collection() -> chromadb.Collection:
         _collection = client.get_or_create_collection(
             name=CHROMA_COLLECTION_NAME,
             metadata={"hnsw:space": "cosine"},
+            embedding_function=_get_embedding_function(),
         )
+        # Число документов запоминается (collection_count) — проверка пустой БД при старте его переиспользует
         log.info(
             "ChromaDB: коллекция '%s' — документов: %d",
             CHROMA_COLLECTION_NAME,
-            _collection.count(),
+            collection_count(),
         )
     return _collection
 
 
+# Число документов: им ограничивается n_results в поиске, его показывает /health.
+# Меняется только при индексации (сбрасывается в index_chunks / remove_by_ids);
+# TTL — на случай индексации из другого процесса (планировщик, scheduler.py).
+_COUNT_TTL = 30.0
+_count: tuple[float, int] | None = None   # (истекает в, число); кортеж заменяется целиком — без блокировки
+
+
+def collection_count() -> int:
+    """Число документов в коллекции (кешируется на _COUNT_TTL секунд)."""
+    global _count
+    cached = _count
+    now = time.monotonic()
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    count = get_collection().count()
+    _count = (now + _COUNT_TTL, count)
+    return count
+
+
+def _invalidate_caches() -> None:
+    """Коллекция изменилась: сбрасывает кешированные число документов и результаты поиска."""
+    global _count
+    _count = None
+    with _results_lock:
+        _results.clear()
+
+
 # ─── Индексация ────────────────────────────────────────────────────────────────
 
 def index_chunks(chunks: list[dict]) -> int:
     """
     Добавляет / обновляет чанки в коллекции (upsert).
-    Дедуплицирует по ID перед отправкой в ChromaDB.
-    Возвращает количество обработанных документов.
+    Дедуплицирует по ID перед отправкой в ChromaDB и отправляет пачками по CHROMA_UPSERT_BATCH_SIZE;
+    пачка с ошибкой пропускается, остальные загружаются.
+    Возвращает количество загруженных документов.
     """
     if not chunks:
         log.warning("index_chunks: пустой список чанков")
         return 0
 
-    # Дедупликация: если несколько чанков с одинаковым ID — оставляем первый
-    seen: dict[str, int] = {}
-    unique_chunks: list[dict] = []
+    # Дедупликация: если несколько чанков с одинаковым ID — оставляем первый.
+    # Поля раскладываются по трём спискам за один проход — пачки дальше только срезаются
+    ids: list[str] = []
+    documents: list[str] = []
+    metadatas: list[dict] = []
+    seen: set[str] = set()
     for chunk in chunks:
         cid = chunk["id"]
         if cid not in seen:
-            seen[cid] = len(unique_chunks)
-            unique_chunks.append(chunk)
+            seen.add(cid)
+            ids.append(cid)
+            documents.append(chunk["text"])
+            metadatas.append(chunk["metadata"])
 
-    if len(unique_chunks) < len(chunks):
+    if len(ids) < len(chunks):
         log.warning(
             "index_chunks: убрано %d дубликатов ID",
-            len(chunks) - len(unique_chunks),
+            len(chunks) - len(ids),
         )
 
     col = get_collection()
-
-    ids = [c["id"] for c in unique_chunks]
-    documents = [c["text"] for c in unique_chunks]
-    metadatas = [c["metadata"] for c in unique_chunks]
-
-    col.upsert(ids=ids, documents=documents, metadatas=metadatas)
-    log.info("ChromaDB: upsert %d документов", len(ids))
-    return len(ids)
+    total = len(ids)
+    size = CHROMA_UPSERT_BATCH_SIZE
+    done = 0
+
+    # Конвейер: пока пачка записывается в ChromaDB, модель в соседнем потоке считает эмбеддинги
+    # следующей (ONNX и запись в SQLite/HNSW отпускают GIL). ID пачек не пересекаются после дедупликации.
+    with ThreadPoolExecutor(max_workers=1) as embedder:
+        pending = embedder.submit(_embeddings_for, col, ids[:size], documents[:size])
+        for start in range(0, total, size):
+            end = start + size
+            current = pending
+            if end < total:
+                pending = embedder.submit(_embeddings_for, col, ids[end:end + size], documents[end:end + size])
+            batch_ids = ids[start:end]
+            try:
+                col.upsert(
+                    ids=batch_ids,
+                    documents=documents[start:end],
+                    embeddings=current.result(),
+                    metadatas=metadatas[start:end],
+                )
+            except Exception as exc:
+                log.error("ChromaDB: пачка %d–%d не загружена — %s", start + 1, start + len(batch_ids), exc)
+                continue
+            done += len(batch_ids)
+            log.info("ChromaDB: upsert %d/%d", min(end, total), total)
+
+    _invalidate_caches()
+    log.info("ChromaDB: upsert %d документов из %d", done, total)
+    return done
+
+
+def _embeddings_for(col: chromadb.Collection, ids: list[str], documents: list[str]) -> list:
+    """
+    Эмбеддинги пачки. Если текст документа в коллекции не изменился, берётся сохранённый вектор —
+    модель считает только новые и изменённые тексты (при переиндексации почти все тексты прежние).
+    """
+    stored = col.get(ids=ids, include=["documents", "embeddings"])
+    stored_embeddings = stored.get("embeddings")
+    known: dict[str, tuple[str, object]] = {}
+    if stored_embeddings is not None:
+        known = {
+            doc_id: (doc, emb)
+            for doc_id, doc, emb in zip(stored["ids"], stored["documents"], stored_embeddings)
+        }
+
+    embeddings: list = [None] * len(ids)
+    missing: list[int] = []
+    for i, (doc_id, text) in enumerate(zip(ids, documents)):
+        hit = known.get(doc_id)
+        if hit is not None and hit[0] == text:
+            embeddings[i] = hit[1]
+        else:
+            missing.append(i)
+    if missing:
+        fresh = _get_embedding_function()([documents[i] for i in missing])
+        for i, emb in zip(missing, fresh):
+            embeddings[i] = emb
+    log.debug("ChromaDB: эмбеддингов посчитано %d, взято из коллекции %d", len(missing), len(ids) - len(missing))
+    return embeddings
 
 
 def remove_by_ids(article_ids: list[str]) -> int:
@@ -115,7 +236,9 @@ def remove_by_ids(article_ids: list[str]) -> int:
     if not unique_ids:
         return 0
     col = get_collection()
-    col.delete(ids=unique_ids)
+    for start in range(0, len(unique_ids), CHROMA_UPSERT_BATCH_SIZE):
+        col.delete(ids=unique_ids[start:start + CHROMA_UPSERT_BATCH_SIZE])
+    _invalidate_caches()
     log.info("ChromaDB: удалено %d документов", len(unique_ids))
     return len(unique_ids)
 
@@ -128,6 +251,35 @@ def reindex_all() -> int:
 
 # ─── Поиск ─────────────────────────────────────────────────────────────────────
 
+# Последние эмбеддинги запросов: поиск с ослаблением фильтров и повторные запросы
+# не прогоняют один и тот же текст через модель заново. Доступ — из потоков пула.
+_query_embeddings = TTLCache(maxsize=256, ttl=3600)
+_query_embeddings_lock = threading.Lock()
+
+
+def embed_queries(texts: list[str]) -> list[np.ndarray]:
+    """
+    Эмбеддинги текстов той же моделью, что у коллекции, нормированные до единичной длины.
+    Отсутствующие в кеше тексты считаются одним вызовом модели.
+    """
+    with _query_embeddings_lock:
+        vectors = {t: _query_embeddings.get(t) for t in texts}
+    missing = [t for t, vec in vectors.items() if vec is None]
+    if missing:
+        for text, raw in zip(missing, _get_embedding_function()(missing)):
+            vector = np.asarray(raw, dtype=np.float32)
+            norm = float(np.linalg.norm(vector))
+            vectors[text] = vector / norm if norm else vector
+        with _query_embeddings_lock:
+            for text in missing:
+                _query_embeddings.set(text, vectors[text])
+    return [vectors[t] for t in texts]
+
+
+def embed_query(text: str) -> np.ndarray:
+    return embed_queries([text])[0]
+
+
 def search(
     query: str,
     n_results: int = 5,
@@ -144,14 +296,58 @@ def search(
     Возвращает список словарей с ключами:
         id, text, metadata, distance
     """
+    return search_many([query], n_results=n_results, where=where)[0]
+
+
+# Последние результаты поиска: повторные нажатия кнопок и одинаковые вопросы не идут в модель и HNSW.
+# Сбрасывается при записи в коллекцию; TTL — на случай индексации из другого процесса. Доступ — из потоков пула.
+_results = TTLCache(maxsize=512, ttl=300)
+_results_lock = threading.Lock()
+
+
+def search_many(
+    queries: list[str],
+    n_results: int = 5,
+    where: Optional[dict] = None,
+) -> list[list[dict]]:
+    """
+    Несколько запросов с общими n_results и where — один вызов collection.query.
+    Пустые запросы и запросы из кеша результатов в ChromaDB не отправляются.
+    """
+    where_key = json.dumps(where, sort_keys=True, ensure_ascii=False) if where else ""
+    batches: list[list[dict]] = [[] for _ in queries]
+    todo: list[int] = []
+    with _results_lock:
+        for i, query in enumerate(queries):
+            # Пустые запросы (команда без текста, пробелы) не прогоняются через модель и HNSW
+            if n_results <= 0 or not query or query.isspace():
+                continue
+            hit = _results.get((query, n_results, where_key))
+            if hit is None:
+                todo.append(i)
+            else:
+                batches[i] = list(hit)
+    if not todo:
+        return batches
+
+    found = _query_collection([queries[i] for i in todo], n_results, where)
+    with _results_lock:
+        for i, items in zip(todo, found):
+            _results.set((queries[i], n_results, where_key), tuple(items))
+            batches[i] = items
+    return batches
+
+
+def _query_collection(queries: list[str], n_results: int, where: Optional[dict]) -> list[list[dict]]:
+    """Поиск в ChromaDB без кеша: эмбеддинги всех запросов и один collection.query."""
     col = get_collection()
-    total = col.count()
+    total = collection_count()
     if total == 0:
         log.warning("ChromaDB: коллекция пуста, поиск невозможен")
-        return []
+        return [[] for _ in queries]
 
     kwargs: dict = {
-        "query_texts": [query],
+        "query_embeddings": embed_queries(queries),
         "n_results": min(n_results, total),
     }
     if where:
@@ -167,19 +363,95 @@ def search(
                 kwargs.pop("where", None)
                 results = col.query(**kwargs)
             except Exception:
-                return []
+                return [[] for _ in queries]
         else:
-            return []
-
-    items: list[dict] = []
-    if results and results["ids"]:
-        for i, doc_id in enumerate(results["ids"][0]):
-            items.append({
-                "id": doc_id,
-                "text": results["documents"][0][i] if results["documents"] else "",
-                "metadata": results["metadatas"][0][i] if results["metadatas"] else {},
-                "distance": results["distances"][0][i] if results["distances"] else 1.0,
-            })
-
-    log.debug("Поиск '%s': найдено %d результатов", query[:60], len(items))
-    return items
+            return [[] for _ in queries]
+
+    all_ids = results.get("ids")
+    if not all_ids or not any(all_ids):
+        log.debug("Поиск: ничего не найдено (%d запросов)", len(queries))
+        return [[] for _ in queries]
+    # Наличие полей проверяется один раз на весь ответ, а не для каждого документа
+    all_documents = results.get("documents")
+    all_metadatas = results.get("metadatas")
+    all_distances = results.get("distances")
+
+    batches: list[list[dict]] = []
+    for q, query in enumerate(queries):
+        ids = all_ids[q]
+        items = [
+            {"id": doc_id, "text": text, "metadata": metadata, "distance": distance}
+            for doc_id, text, metadata, distance in zip(
+                ids,
+                all_documents[q] if all_documents else repeat(""),
+                all_metadatas[q] if all_metadatas else [{} for _ in ids],
+                all_distances[q] if all_distances else repeat(1.0),
+            )
+        ]
+        log.debug("Поиск '%s': найдено %d результатов", query[:60], len(items))
+        batches.append(items)
+    return batches
+
+
+class SearchBatcher:
+    """
+    Объединяет поисковые запросы, пришедшие почти одновременно (в пределах window секунд),
+    в один collection.query. Запросы с разными n_results / where в одну пачку не попадают.
+    """
+
+    def __init__(self, window: float = 0.005, max_batch: int = 32) -> None:
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: dict[str, list[tuple[str, asyncio.Future]]] = {}
+        self._tasks: set[asyncio.Task] = set()  # ссылки на фоновые задачи, чтобы их не собрал GC
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def search(self, query: str, n_results: int = 5, where: Optional[dict] = None) -> list[dict]:
+        key = json.dumps([n_results, where], sort_keys=True, ensure_ascii=False)
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        group = self._pending.get(key)
+        if group is None:
+            group = self._pending[key] = []
+            self._spawn(self._flush_later(key, group, n_results, where))
+        group.append((query, future))
+        if len(group) >= self.max_batch:
+            del self._pending[key]
+            self._spawn(self._run(group, n_results, where))
+        return await future
+
+    async def _flush_later(
+        self, key: str, group: list[tuple[str, asyncio.Future]], n_results: int, where: Optional[dict],
+    ) -> None:
+        await asyncio.sleep(self.window)
+        if self._pending.get(key) is group:  # пачка не ушла раньше по max_batch
+            del self._pending[key]
+            await self._run(group, n_results, where)
+
+    @staticmethod
+    async def _run(
+        group: list[tuple[str, asyncio.Future]], n_results: int, where: Optional[dict],
+    ) -> None:
+        try:
+            batches = await asyncio.to_thread(
+                search_many, [q for q, _ in group], n_results=n_results, where=where,
+            )
+        except Exception as exc:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, future), items in zip(group, batches):
+            if not future.done():
+                future.set_result(items)
+
+
+_batcher = SearchBatcher()
+
+
+async def search_async(query: str, n_results: int = 5, where: Optional[dict] = None) -> list[dict]:
+    """search() для async-кода: в отдельном потоке и пачками с одновременными запросами."""
+    return await _batcher.search(query, n_results=n_results, where=where)